@@ -0,0 +1,247 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+STATS_JOIN_SIZES = [1000, 10000, 100000, 200000]
+SNAPSHOT_SIZES = [10000, 100000] # merged cards, in END_TO_END_LANGUAGES
+CARD_MODEL_SIZES = [10000, 100000] # merged cards, in END_TO_END_LANGUAGES
+CARD_INDEX_SIZES = [10000, 100000] # merged cards, in END_TO_END_LANGUAGES
+SUBTYPES_COLS_SIZES = [(10000, 500), (50000, 2000), (200000, 5000)] # (cards, distinct subtypes)
+END_TO_END_SIZES = [1000, 10000] # cards served by the mock API, up to 1M
+END_TO_END_LANGUAGES = ["en", "fr"]
+END_TO_END_WORKERS = 8 # parallel requests for the fetch and image download stages
+END_TO_END_IMAGE_CARDS = 1000 # number of cards whose images are downloaded (first language only)
+END_TO_END_LATENCY = 0 # seconds added by the mock API to every response
+TRACE_MEMORY = True # measures the peak memory with tracemalloc, which slows down the stages noticeably
+BENCHMARK_OUTPUT_PATH = None # e.g. "benchmark.json" to save the end-to-end results and compare releases
+
+# Imports
+import os
+import json
+import time
+import random
+import tempfile
+import contextlib
+import tracemalloc
+import utils
+import get_cards_data
+import get_card_images
+import get_csv_data
+from get_cards_data import index_stats_data, treat_cards_data, merge_cards_data, merge_language_dicts
+from get_csv_data import get_subtypes_cols
+from card_model import CompactCards
+from card_index import CardIndex
+from mock_api_server import MockApiServer, make_raw_card, make_raw_stats
+
+def benchmark_stats_join(sizes=STATS_JOIN_SIZES):
+    print("==== Collection stats join ====")
+    print(f"{'entries':>10} {'index (s)':>10} {'treat (s)':>10} {'us/entry':>10}")
+    for size in sizes:
+        cards_data = [make_raw_card(i) for i in range(size)]
+        stats_data = [make_raw_stats(i) for i in range(size)]
+        start = time.perf_counter()
+        stats_index = index_stats_data(stats_data)
+        index_time = time.perf_counter() - start
+        start = time.perf_counter()
+        treat_cards_data(cards_data, stats_index, include_uniques=True, include_ks=True, include_promo_cards=True, include_foilers=True, force_include_ks_uniques=False)
+        treat_time = time.perf_counter() - start
+        print(f"{size:>10} {index_time:>10.3f} {treat_time:>10.3f} {(index_time + treat_time) / size * 1e6:>10.2f}")
+
+def benchmark_snapshot(sizes=SNAPSHOT_SIZES, languages=END_TO_END_LANGUAGES):
+    print("==== Loading the results: json module, load_json without snapshot, snapshot ====")
+    print(f"{'cards':>10} {'json (s)':>10} {'load_json (s)':>14} {'snapshot (s)':>12} {'JSON (MB)':>10} {'snapshot (MB)':>14}")
+    for size in sizes:
+        treated = {language: treat_cards_data([make_raw_card(i, language) for i in range(size)], {}, include_uniques=True, include_ks=True, include_promo_cards=True, include_foilers=True, force_include_ks_uniques=False)[0] for language in languages}
+        cards = merge_cards_data(treated, skip_not_all_languages=False, is_collection=False)
+        del treated
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "cards.json")
+            utils.dump_json(cards, path, snapshot=True)
+            start = time.perf_counter()
+            with open(path, encoding="utf8") as f:
+                from_json = json.load(f)
+            json_time = time.perf_counter() - start
+            start = time.perf_counter()
+            utils.load_json(path)
+            load_json_time = time.perf_counter() - start
+            start = time.perf_counter()
+            from_snapshot = utils.load_snapshot(path)
+            snapshot_time = time.perf_counter() - start
+            assert from_snapshot == from_json
+            print(f"{size:>10} {json_time:>10.3f} {load_json_time:>14.3f} {snapshot_time:>12.3f} {os.path.getsize(path) / 1e6:>10.1f} {os.path.getsize(utils.snapshot_path(path)) / 1e6:>14.1f}")
+
+def benchmark_card_model(sizes=CARD_MODEL_SIZES, languages=END_TO_END_LANGUAGES):
+    print("==== Memory of the cards: dicts loaded from JSON, compact model ====")
+    print(f"{'cards':>10} {'dicts (B/card)':>15} {'compact (B/card)':>17} {'ratio':>6} {'build (s)':>10} {'lookup (us)':>12}")
+    for size in sizes:
+        treated = {language: treat_cards_data([make_raw_card(i, language) for i in range(size)], {}, include_uniques=True, include_ks=True, include_promo_cards=True, include_foilers=True, force_include_ks_uniques=False)[0] for language in languages}
+        text = json.dumps(merge_cards_data(treated, skip_not_all_languages=False, is_collection=False), ensure_ascii=False)
+        del treated
+        tracemalloc.start()
+        cards = json.loads(text)
+        dicts_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        model = CompactCards(cards)
+        compact_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        CompactCards(cards)
+        build_time = time.perf_counter() - start
+        card_ids = random.Random(0).sample(list(cards), min(size, 10000))
+        start = time.perf_counter()
+        for card_id in card_ids:
+            model[card_id]
+        lookup_time = time.perf_counter() - start
+        assert model.to_dict() == cards
+        print(f"{size:>10} {dicts_memory / size:>15.0f} {compact_memory / size:>17.0f} {dicts_memory / compact_memory:>6.1f} {build_time:>10.3f} {lookup_time / len(card_ids) * 1e6:>12.1f}")
+
+def benchmark_card_index(sizes=CARD_INDEX_SIZES, languages=END_TO_END_LANGUAGES):
+    print("==== Card index: build, then queries of the first 50 results against a linear scan ====")
+    queries = [
+        ("faction + rarity + cost", {"faction": "AX", "rarity": "RARE", "main_cost": (2, 4)}, lambda card: card["mainFaction"] == "AX" and card["rarity"] == "RARE" and 2 <= int(card["elements"]["MAIN_COST"]) <= 4),
+        ("factions + cost + power", {"faction": ["AX", "BR"], "main_cost": (0, 2), "forest_power": (2, None)}, lambda card: card["mainFaction"] in ["AX", "BR"] and int(card["elements"]["MAIN_COST"]) <= 2 and int(card["elements"]["FOREST_POWER"]) >= 2),
+        ("effect text + faction", {"text": "support", "faction": "LY"}, lambda card: card["mainFaction"] == "LY" and "ECHO_EFFECT" in card["elements"])
+    ]
+    print(f"{'cards':>10} {'build (s)':>10} {'query':>25} {'index (us)':>11} {'scan (us)':>10}")
+    for size in sizes:
+        treated = {language: treat_cards_data([make_raw_card(i, language) for i in range(size)], {}, include_uniques=True, include_ks=True, include_promo_cards=True, include_foilers=True, force_include_ks_uniques=False)[0] for language in languages}
+        cards = merge_cards_data(treated, skip_not_all_languages=False, is_collection=False)
+        del treated
+        start = time.perf_counter()
+        index = CardIndex(cards)
+        build_time = time.perf_counter() - start
+        for name, criteria, predicate in queries:
+            index.search(limit=50, **criteria)
+            start = time.perf_counter()
+            for _ in range(100):
+                results = index.search(limit=50, **criteria)
+            index_time = (time.perf_counter() - start) / 100
+            start = time.perf_counter()
+            expected = [card_id for card_id, card in cards.items() if predicate(card)][:50]
+            scan_time = time.perf_counter() - start
+            assert results == expected
+            print(f"{size:>10} {build_time:>10.3f} {name:>25} {index_time * 1e6:>11.1f} {scan_time * 1e6:>10.0f}")
+
+def make_subtypes_catalog(nb_cards, nb_subtypes, seed=0):
+    # Merged cards with 0 to 3 subtypes, drawn with a skewed distribution as in the real catalog
+    rng = random.Random(seed)
+    subtypes = [f"SUBTYPE_{i}" for i in range(nb_subtypes)]
+    weights = [1 / (i + 1) for i in range(nb_subtypes)]
+    data = {}
+    for i in range(nb_cards):
+        card_subtypes = set(rng.choices(subtypes, weights=weights, k=rng.randint(0, 3)))
+        data[str(i)] = {"id": str(i), "subtypes": sorted(card_subtypes)}
+    return data
+
+def benchmark_subtypes_cols(sizes=SUBTYPES_COLS_SIZES):
+    print("==== Subtype columns ====")
+    print(f"{'cards':>10} {'subtypes':>10} {'time (s)':>10} {'columns':>10}")
+    for nb_cards, nb_subtypes in sizes:
+        data = make_subtypes_catalog(nb_cards, nb_subtypes)
+        start = time.perf_counter()
+        subtypes_cols = get_subtypes_cols(data)
+        elapsed = time.perf_counter() - start
+        print(f"{nb_cards:>10} {nb_subtypes:>10} {elapsed:>10.3f} {max(subtypes_cols.values()) + 1:>10}")
+
+def folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+def run_stage(name, server, output_folder, function, *args):
+    # Runs function(*args) and measures its wall time, requests to the mock API, peak
+    # memory (traced Python allocations, when TRACE_MEMORY) and bytes written to output_folder
+    requests_before = server.nb_requests
+    bytes_before = folder_size(output_folder)
+    if TRACE_MEMORY:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = function(*args)
+    wall_time = time.perf_counter() - start
+    nb_requests = server.nb_requests - requests_before
+    return result, {
+        "stage": name,
+        "wall_time": wall_time,
+        "requests": nb_requests,
+        "requests_per_second": nb_requests / wall_time if wall_time else 0,
+        "peak_memory": tracemalloc.get_traced_memory()[1] if TRACE_MEMORY else None,
+        "bytes_written": folder_size(output_folder) - bytes_before
+    }
+
+def benchmark_end_to_end(sizes=END_TO_END_SIZES, languages=END_TO_END_LANGUAGES):
+    print("==== End to end (mock API) ====")
+    print(f"{'cards':>8} {'stage':>8} {'wall (s)':>10} {'requests':>10} {'req/s':>10} {'peak (MB)':>10} {'written (MB)':>12}")
+    utils.REQUESTS_PER_SECOND = None # The mock API is local, no need to be polite
+    results = []
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    try:
+        for size in sizes:
+            with MockApiServer(nb_cards=size, port=0, latency=END_TO_END_LATENCY) as server, tempfile.TemporaryDirectory() as output_folder:
+                get_cards_data.API_URL = server.url
+                stages = []
+
+                raw_cards, stage = run_stage("fetch", server, output_folder, lambda: get_cards_data.get_data_languages_concurrent(
+                    "cards", languages, include_uniques=True, max_workers=END_TO_END_WORKERS))
+                stages.append(stage)
+
+                def treat(raw_cards):
+                    treated = {}
+                    for language in languages:
+                        treated[language] = treat_cards_data(raw_cards[language], {}, include_uniques=True, include_ks=True, include_promo_cards=True, include_foilers=True, force_include_ks_uniques=False)
+                    return treated
+                treated, stage = run_stage("treat", server, output_folder, treat, raw_cards)
+                stages.append(stage)
+                del raw_cards
+
+                def merge(treated):
+                    cards = merge_cards_data({language: treated[language][0] for language in languages}, skip_not_all_languages=False, is_collection=False)
+                    tables = [merge_language_dicts({language: treated[language][i] for language in languages}) for i in range(1, 5)]
+                    return cards, tables
+                (cards, (types, subtypes, factions, rarities)), stage = run_stage("merge", server, output_folder, merge, treated)
+                stages.append(stage)
+                del treated
+
+                _, stage = run_stage("dump", server, output_folder, lambda: utils.dump_json(cards, os.path.join(output_folder, "cards.json")))
+                stages.append(stage)
+
+                get_csv_data.CSV_OUTPUT_PATH = os.path.join(output_folder, "cards_{language}.csv")
+                _, stage = run_stage("csv", server, output_folder, lambda: get_csv_data.write_csv_files(cards, types, subtypes, factions, rarities, languages))
+                stages.append(stage)
+
+                get_card_images.LANGUAGES = languages[:1]
+                get_card_images.CARD_IMAGES_FOLDER = os.path.join(output_folder, "card_images")
+                get_card_images.MANIFEST_PATH = os.path.join(output_folder, "manifest.json")
+                image_cards = dict(list(cards.items())[:END_TO_END_IMAGE_CARDS])
+                def download_images():
+                    manifest = get_card_images.load_manifest()
+                    downloads, revalidations, _ = get_card_images.plan_downloads(get_card_images.plan_files(image_cards), manifest)
+                    return get_card_images.download_all(downloads + revalidations, manifest, max_workers=END_TO_END_WORKERS)
+                _, stage = run_stage("images", server, output_folder, download_images)
+                stages.append(stage)
+
+                for stage in stages:
+                    peak_memory = f"{stage['peak_memory'] / 1e6:.1f}" if stage["peak_memory"] is not None else "-"
+                    print(f"{size:>8} {stage['stage']:>8} {stage['wall_time']:>10.3f} {stage['requests']:>10} {stage['requests_per_second']:>10.1f} {peak_memory:>10} {stage['bytes_written'] / 1e6:>12.2f}")
+                results.append({"cards": size, "languages": languages, "stages": stages})
+    finally:
+        if TRACE_MEMORY:
+            tracemalloc.stop()
+    if BENCHMARK_OUTPUT_PATH:
+        utils.dump_json(results, BENCHMARK_OUTPUT_PATH)
+    return results
+
+def main():
+    benchmark_stats_join()
+    benchmark_subtypes_cols()
+    benchmark_snapshot()
+    benchmark_card_model()
+    benchmark_card_index()
+    benchmark_end_to_end()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Imports
+import re
+import threading
+import unicodedata
+from array import array
+from os.path import join
+from collections import OrderedDict
+from utils import load_results_json
+from get_cards_data import OUTPUT_FOLDER
+
+# Constants
+# Search argument -> element of the cards, indexed by numeric value
+NUMERIC_ELEMENTS = {
+    "main_cost": "MAIN_COST",
+    "recall_cost": "RECALL_COST",
+    "forest_power": "FOREST_POWER",
+    "mountain_power": "MOUNTAIN_POWER",
+    "ocean_power": "OCEAN_POWER"
+}
+NGRAM_SIZE = 3 # words are looked up in the effects through their n-grams, shorter words through all the tokens
+SPARSE_RATIO = 256 # values of fewer than 1 / SPARSE_RATIO of the cards are kept as arrays of positions rather than bitmaps
+TEXT_CACHE_SIZE = 1024 # bitmaps of the last words searched in the effects
+TOKEN_REGEX = re.compile(r"\w+")
+ONE_REGEX = re.compile("1")
+MIN_CHUNK_BITS = 64
+MAX_CHUNK_BITS = 65536
+
+def normalize_text(text):
+    # Lower case, without accents
+    if text.isascii():
+        return text.lower()
+    return "".join(char for char in unicodedata.normalize("NFKD", text.casefold()) if not unicodedata.combining(char))
+
+def tokenize(text):
+    return TOKEN_REGEX.findall(normalize_text(text))
+
+def parse_number(value):
+    # Costs and powers are strings in the API, e.g. "3", None when not a number
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value.strip("# "))
+        except ValueError:
+            return None
+    return None
+
+def positions_to_bitmap(positions):
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+def bitmap_to_positions(bitmap, limit=None):
+    # Positions of the set bits, in increasing order, the first limit ones if limit is set.
+    # The bitmap is read by chunks growing from MIN_CHUNK_BITS, so that the first results do
+    # not cost a pass over all the cards
+    positions = []
+    start = 0
+    chunk_bits = MIN_CHUNK_BITS
+    while bitmap and (limit is None or len(positions) < limit):
+        # Skips to the lowest set bit
+        skip = (bitmap & -bitmap).bit_length() - 1
+        bitmap >>= skip
+        start += skip
+        chunk = bitmap & ((1 << chunk_bits) - 1)
+        positions += [start + match.start() for match in ONE_REGEX.finditer(bin(chunk)[:1:-1])]
+        bitmap >>= chunk_bits
+        start += chunk_bits
+        chunk_bits = min(2 * chunk_bits, MAX_CHUNK_BITS)
+    return positions[:limit]
+
+class CardIndex:
+    # Inverted indexes over the merged cards (the content of cards.json, or a CompactCards).
+    # Every index maps a value to the cards having it, as a bitmap (a Python int whose bit p
+    # is set for the card at position p) or, for rare values, as an array of positions, so
+    # that a combined query is a few bitwise operations. The index is read only: build it
+    # again when the cards change
+    def __init__(self, cards, subtypes=None, factions=None):
+        self.cards = cards
+        self.ids = []
+        postings = {"faction": {}, "rarity": {}, "type": {}, "subtype": {}}
+        postings.update({element: {} for element in NUMERIC_ELEMENTS.values()})
+        printed = {}
+        formatted = {} # language -> collector number -> positions
+        tokens = {} # language -> token of the effects -> positions
+        for card_id, card in cards.items():
+            position = len(self.ids)
+            self.ids.append(card_id)
+            postings["faction"].setdefault(card["mainFaction"], []).append(position)
+            postings["rarity"].setdefault(card["rarity"], []).append(position)
+            postings["type"].setdefault(card["type"], []).append(position)
+            for subtype in set(card["subtypes"]):
+                postings["subtype"].setdefault(subtype, []).append(position)
+            elements = card.get("elements") or {}
+            for element in NUMERIC_ELEMENTS.values():
+                number = parse_number(elements.get(element))
+                if number is not None:
+                    postings[element].setdefault(number, []).append(position)
+            printed.setdefault(normalize_text(card["collectorNumberPrinted"]), []).append(position)
+            for language, collector_number in card["collectorNumberFormatted"].items():
+                formatted.setdefault(language, {}).setdefault(normalize_text(collector_number), []).append(position)
+            card_tokens = {}
+            for value in elements.values():
+                if isinstance(value, dict):
+                    for language, text in value.items():
+                        card_tokens.setdefault(language, set()).update(tokenize(text))
+            for language, language_tokens in card_tokens.items():
+                language_postings = tokens.setdefault(language, {})
+                for token in language_tokens:
+                    language_postings.setdefault(token, []).append(position)
+
+        self.postings = {name: {value: self.compact(positions) for value, positions in values.items()} for name, values in postings.items()}
+        self.printed = {number: array('I', positions) for number, positions in printed.items()}
+        self.formatted = {language: {number: array('I', positions) for number, positions in numbers.items()} for language, numbers in formatted.items()}
+        self.tokens = {language: {token: self.compact(positions) for token, positions in language_postings.items()} for language, language_postings in tokens.items()}
+        # Substring search: n-gram -> tokens containing it, per language
+        self.ngrams = {}
+        for language, language_postings in self.tokens.items():
+            ngrams = self.ngrams[language] = {}
+            for token in language_postings:
+                for i in range(len(token) - NGRAM_SIZE + 1):
+                    ngrams.setdefault(token[i:i + NGRAM_SIZE], set()).add(token)
+        # Localized names of the factions and subtypes, which can be searched instead of the references
+        self.references = {"faction": {}, "subtype": {}}
+        for name, table in [("faction", factions), ("subtype", subtypes)]:
+            for reference, names in (table or {}).items():
+                for localized in (names.values() if isinstance(names, dict) else []):
+                    self.references[name].setdefault(normalize_text(localized), reference)
+        self.all_cards = (1 << len(self.ids)) - 1
+        self.text_cache = OrderedDict()
+        self.text_cache_lock = threading.Lock() # the searches may run in several threads
+
+    def compact(self, positions):
+        if len(positions) * SPARSE_RATIO < len(self.ids):
+            return array('I', positions)
+        return positions_to_bitmap(positions)
+
+    def bitmap(self, posting):
+        if isinstance(posting, int):
+            return posting
+        return positions_to_bitmap(posting)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def value_bitmap(self, name, value):
+        # value: a reference (or a localized name of a faction or subtype), or a list of them
+        values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+        postings = self.postings[name]
+        bitmap = 0
+        for one_value in values:
+            if one_value not in postings and isinstance(one_value, str):
+                one_value = self.references.get(name, {}).get(normalize_text(one_value), one_value)
+            bitmap |= self.bitmap(postings.get(one_value, 0))
+        return bitmap
+
+    def number_bitmap(self, element, value):
+        # value: a number, or an inclusive (min, max) range where None is unbounded
+        postings = self.postings[element]
+        if not isinstance(value, tuple):
+            return self.bitmap(postings.get(value, 0))
+        low, high = value
+        bitmap = 0
+        for number, posting in postings.items():
+            if (low is None or number >= low) and (high is None or number <= high):
+                bitmap |= self.bitmap(posting)
+        return bitmap
+
+    def word_bitmap(self, word, language, whole_words):
+        # Cards whose effects in language contain word, as a whole word or in a word
+        key = (word, language, whole_words)
+        with self.text_cache_lock:
+            if key in self.text_cache:
+                self.text_cache.move_to_end(key)
+                return self.text_cache[key]
+        language_postings = self.tokens.get(language, {})
+        if whole_words:
+            bitmap = self.bitmap(language_postings.get(word, 0))
+        else:
+            # Tokens containing all the n-grams of the word, then checked
+            candidates = language_postings if len(word) < NGRAM_SIZE else None
+            for i in range(len(word) - NGRAM_SIZE + 1):
+                tokens = self.ngrams.get(language, {}).get(word[i:i + NGRAM_SIZE], set())
+                candidates = tokens if candidates is None else candidates & tokens
+                if not candidates:
+                    break
+            positions = []
+            bitmap = 0
+            for token in candidates or ():
+                if word in token:
+                    posting = language_postings[token]
+                    if isinstance(posting, int):
+                        bitmap |= posting
+                    else:
+                        positions += posting
+            bitmap |= positions_to_bitmap(positions)
+        with self.text_cache_lock:
+            self.text_cache[key] = bitmap
+            if len(self.text_cache) > TEXT_CACHE_SIZE:
+                self.text_cache.popitem(last=False)
+        return bitmap
+
+    def collector_number_positions(self, collector_number, language=None):
+        # Printed collector number, or formatted one in language (any language if None)
+        key = normalize_text(collector_number)
+        if key in self.printed:
+            return list(self.printed[key])
+        languages = [language] if language is not None else list(self.formatted)
+        return sorted({position for one_language in languages for position in self.formatted.get(one_language, {}).get(key, ())})
+
+    def match(
+        self,
+        faction=None,
+        rarity=None,
+        type=None,
+        subtype=None,
+        text=None,
+        language="en",
+        whole_words=False,
+        collector_number=None,
+        **numbers
+    ):
+        # Bitmap of the cards matching every given criterion, see search
+        bitmap = self.all_cards
+        for name, value in [("faction", faction), ("rarity", rarity), ("type", type), ("subtype", subtype)]:
+            if value is not None and bitmap:
+                bitmap &= self.value_bitmap(name, value)
+        for argument, value in numbers.items():
+            if argument not in NUMERIC_ELEMENTS:
+                raise TypeError(f"search() got an unexpected keyword argument '{argument}'")
+            if value is not None and bitmap:
+                bitmap &= self.number_bitmap(NUMERIC_ELEMENTS[argument], value)
+        if text and bitmap:
+            for word in tokenize(text):
+                bitmap &= self.word_bitmap(word, language, whole_words)
+        if collector_number is not None and bitmap:
+            bitmap &= positions_to_bitmap(self.collector_number_positions(collector_number))
+        return bitmap
+
+    def search(self, limit=None, offset=0, **criteria):
+        # Ids of the cards matching every given criterion, in the order of the cards.
+        # faction, rarity, type, subtype: a reference (or a localized name of a faction or
+        # subtype), or a list of them (any of them). main_cost, recall_cost, forest_power,
+        # mountain_power, ocean_power: a number or an inclusive (min, max) range, None being
+        # unbounded. text: words that must all appear in the effects of the card in language,
+        # inside their words unless whole_words is set. collector_number: printed or formatted
+        positions = bitmap_to_positions(self.match(**criteria), None if limit is None else offset + limit)
+        return [self.ids[position] for position in positions[offset:]]
+
+    def count(self, **criteria):
+        return bin(self.match(**criteria)).count("1")
+
+    def search_cards(self, limit=None, offset=0, **criteria):
+        # Same as search, returning the cards
+        return [self.cards[card_id] for card_id in self.search(limit, offset, **criteria)]
+
+    def by_collector_number(self, collector_number, language=None):
+        # Ids of the cards with this collector number, e.g. "BTG-001-C"
+        return [self.ids[position] for position in self.collector_number_positions(collector_number, language)]
+
+def load_card_index(output_folder=OUTPUT_FOLDER):
+    # Builds the index from the results of get_cards_data.py
+    cards, subtypes, factions = [load_results_json(join(output_folder, name + ".json")) for name in ["cards", "subtypes", "factions"]]
+    return CardIndex(cards, subtypes, factions)
@@ -0,0 +1,367 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Imports
+import copy
+import json
+import zlib
+from array import array
+from os.path import join
+from utils import load_results_json
+from get_cards_data import OUTPUT_FOLDER
+
+# Constants
+HEAD_PROPERTIES = ["id", "type", "subtypes", "assets", "mainFaction", "rarity"]
+COLLECTION_PROPERTIES = ["foiled", "inMyTradelist", "inMyCollection", "inMyWantlist"]
+LOCALIZED_PROPERTIES = ["name", "collectorNumberFormatted"] # in the language string pools
+TAIL_PROPERTIES = ["name", "imagePath", "collectorNumberFormatted", "collectorNumberPrinted", "elements"]
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+class StringPool:
+    # Distinct strings stored once, as UTF-8, in a single buffer
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+        self.indexes = {} # only until the pool is frozen
+
+    def add(self, string):
+        index = self.indexes.get(string)
+        if index is None:
+            index = self.indexes[string] = len(self.offsets) - 1
+            self.data += string.encode("utf8")
+            self.offsets.append(len(self.data))
+        return index
+
+    def get(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode("utf8")
+
+    def get_bytes(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def freeze(self):
+        self.data = bytes(self.data)
+        self.offsets = array('I', self.offsets)
+        self.indexes = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class UrlPool(StringPool):
+    # URLs share a few folders: the part up to the last "/" is stored once, as a code
+    def __init__(self):
+        super().__init__()
+        self.folders = CodeTable()
+        self.folder_codes = array('I')
+
+    def add(self, url):
+        index = self.indexes.get(url)
+        if index is None:
+            split = url.rfind("/") + 1
+            index = self.indexes[url] = len(self.offsets) - 1
+            self.data += url[split:].encode("utf8")
+            self.offsets.append(len(self.data))
+            self.folder_codes.append(self.folders.code(url[:split]))
+        return index
+
+    def get(self, index):
+        return self.folders[self.folder_codes[index]] + super().get(index)
+
+    def freeze(self):
+        super().freeze()
+        self.folder_codes = array('I', self.folder_codes)
+
+class CodeTable:
+    # Small integer codes of references (types, factions, elements...), in order of appearance
+    def __init__(self, references=()):
+        self.references = []
+        self.codes = {}
+        for reference in references:
+            self.code(reference)
+
+    def code(self, reference):
+        code = self.codes.get(reference)
+        if code is None:
+            code = self.codes[reference] = len(self.references)
+            self.references.append(reference)
+        return code
+
+    def __getitem__(self, code):
+        return self.references[code]
+
+    def __len__(self):
+        return len(self.references)
+
+class CompactCards:
+    # Merged cards (the content of cards.json) stored in columns: references as codes of the
+    # types / subtypes / factions / rarities tables, texts in one string pool per language,
+    # URLs and other strings in shared pools, and element values as codes of the distinct
+    # values. Cards that do not have the usual shape are kept as they are, so that to_dict()
+    # always gives back the original cards. The model is read only once built
+    def __init__(self, cards, types=None, subtypes=None, factions=None, rarities=None):
+        self.types = CodeTable(types or ())
+        self.subtypes = CodeTable(subtypes or ())
+        self.factions = CodeTable(factions or ())
+        self.rarities = CodeTable(rarities or ())
+        self.asset_kinds = CodeTable()
+        self.element_keys = CodeTable()
+        self.element_values = [] # distinct scalar values of the elements
+        self.languages = []
+        for card in cards.values():
+            if isinstance(card.get("name"), dict):
+                for language in card["name"]:
+                    if language not in self.languages:
+                        self.languages.append(language)
+
+        self.shared_strings = StringPool() # ids, printed collector numbers and collection stats as JSON
+        self.urls = UrlPool() # images and assets
+        self.strings = {language: StringPool() for language in self.languages}
+        self.ids = array('I')
+        self.type_codes = array('H')
+        self.faction_codes = array('H')
+        self.rarity_codes = array('H')
+        self.subtype_offsets = array('I', [0])
+        self.subtype_codes = array('H')
+        self.asset_offsets = array('I', [0])
+        self.asset_kind_codes = array('H')
+        self.asset_urls = array('I')
+        self.printed = array('i')
+        self.collection = array('i')
+        # One string index per card and language, -1 when the card has no text in the language
+        self.localized = {(property, language): array('i') for property in LOCALIZED_PROPERTIES for language in self.languages}
+        self.image_paths = {language: array('i') for language in self.languages}
+        self.element_offsets = array('I', [0])
+        self.element_key_codes = array('H')
+        self.element_value_codes = array('i') # >= 0: distinct value, < 0: -1 - row of effect_texts
+        self.effect_texts = array('i') # one row of len(languages) string indexes per localized element
+        self.raw = {} # position -> card not stored in columns
+
+        value_codes = {}
+        for card_id, card in cards.items():
+            self.ids.append(self.shared_strings.add(card_id))
+            if self.is_encodable(card_id, card):
+                self.add(card, value_codes)
+            else:
+                self.raw[len(self.ids) - 1] = copy.deepcopy(card)
+                self.add_empty()
+        self.freeze()
+
+    def freeze(self):
+        # Trims the columns and builds the index of the ids
+        for name, value in vars(self).items():
+            if isinstance(value, array):
+                setattr(self, name, array(value.typecode, value))
+        for columns in [self.localized, self.image_paths]:
+            for key, column in columns.items():
+                columns[key] = array(column.typecode, column)
+        for pool in [self.shared_strings, self.urls, *self.strings.values()]:
+            pool.freeze()
+        # Open addressing table of the positions, by CRC32 of the id, at most half full
+        size = 1
+        while size < 2 * len(self.ids):
+            size *= 2
+        self.id_table = array('i', [-1]) * size
+        for position, id_index in enumerate(self.ids):
+            slot = zlib.crc32(self.shared_strings.get_bytes(id_index)) & (size - 1)
+            while self.id_table[slot] >= 0:
+                slot = (slot + 1) & (size - 1)
+            self.id_table[slot] = position
+
+    def is_encodable(self, card_id, card):
+        properties = list(card)
+        if properties[:len(HEAD_PROPERTIES)] != HEAD_PROPERTIES or properties[-len(TAIL_PROPERTIES):] != TAIL_PROPERTIES:
+            return False
+        if any(property not in COLLECTION_PROPERTIES for property in properties[len(HEAD_PROPERTIES):-len(TAIL_PROPERTIES)]):
+            return False
+        if card["id"] != card_id or not all(isinstance(card[property], str) for property in ["type", "mainFaction", "rarity", "collectorNumberPrinted"]):
+            return False
+        if not isinstance(card["subtypes"], list) or not all(isinstance(subtype, str) for subtype in card["subtypes"]):
+            return False
+        # No assets is an empty list, otherwise a dict of non empty lists of URLs
+        assets = card["assets"]
+        if assets != [] and not (isinstance(assets, dict) and assets and all(isinstance(urls, list) and urls and all(isinstance(url, str) for url in urls) for urls in assets.values())):
+            return False
+        for property in ["name", "imagePath", "collectorNumberFormatted"]:
+            if not self.is_localized(card[property]):
+                return False
+        if not isinstance(card["elements"], dict):
+            return False
+        for value in card["elements"].values():
+            if isinstance(value, dict):
+                if not self.is_localized(value):
+                    return False
+            elif not isinstance(value, SCALAR_TYPES):
+                return False
+        return True
+
+    def is_localized(self, texts):
+        # The languages must be in the same order as in the other cards
+        return isinstance(texts, dict) and list(texts) == [language for language in self.languages if language in texts] and all(isinstance(text, str) for text in texts.values())
+
+    def add(self, card, value_codes):
+        self.type_codes.append(self.types.code(card["type"]))
+        self.faction_codes.append(self.factions.code(card["mainFaction"]))
+        self.rarity_codes.append(self.rarities.code(card["rarity"]))
+        self.subtype_codes.extend(self.subtypes.code(subtype) for subtype in card["subtypes"])
+        self.subtype_offsets.append(len(self.subtype_codes))
+        for kind, urls in (card["assets"] or {}).items():
+            for url in urls:
+                self.asset_kind_codes.append(self.asset_kinds.code(kind))
+                self.asset_urls.append(self.urls.add(url))
+        self.asset_offsets.append(len(self.asset_urls))
+        self.printed.append(self.shared_strings.add(card["collectorNumberPrinted"]))
+        collection = {property: card[property] for property in card if property in COLLECTION_PROPERTIES}
+        self.collection.append(self.shared_strings.add(json.dumps(collection)) if collection else -1)
+        for language in self.languages:
+            for property in LOCALIZED_PROPERTIES:
+                text = card[property].get(language)
+                self.localized[(property, language)].append(self.strings[language].add(text) if text is not None else -1)
+            image_path = card["imagePath"].get(language)
+            self.image_paths[language].append(self.urls.add(image_path) if image_path is not None else -1)
+        for key, value in card["elements"].items():
+            self.element_key_codes.append(self.element_keys.code(key))
+            if isinstance(value, dict):
+                self.element_value_codes.append(-1 - len(self.effect_texts) // len(self.languages))
+                for language in self.languages:
+                    text = value.get(language)
+                    self.effect_texts.append(self.strings[language].add(text) if text is not None else -1)
+            else:
+                # The type is part of the key, so that 1, 1.0 and True are not confused
+                value_key = (type(value).__name__, value)
+                if value_key not in value_codes:
+                    value_codes[value_key] = len(self.element_values)
+                    self.element_values.append(value)
+                self.element_value_codes.append(value_codes[value_key])
+        self.element_offsets.append(len(self.element_key_codes))
+
+    def add_empty(self):
+        for column in [self.type_codes, self.faction_codes, self.rarity_codes]:
+            column.append(0)
+        for offsets, values in [(self.subtype_offsets, self.subtype_codes), (self.asset_offsets, self.asset_urls), (self.element_offsets, self.element_key_codes)]:
+            offsets.append(len(values))
+        for column in [self.printed, self.collection, *self.localized.values(), *self.image_paths.values()]:
+            column.append(-1)
+
+    def position(self, card_id):
+        # None if the card is unknown
+        key = card_id.encode("utf8")
+        mask = len(self.id_table) - 1
+        slot = zlib.crc32(key) & mask
+        while self.id_table[slot] >= 0:
+            position = self.id_table[slot]
+            if self.shared_strings.get_bytes(self.ids[position]) == key:
+                return position
+            slot = (slot + 1) & mask
+        return None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, card_id):
+        return self.position(card_id) is not None
+
+    def __iter__(self):
+        for id_index in self.ids:
+            yield self.shared_strings.get(id_index)
+
+    def __getitem__(self, card_id):
+        position = self.position(card_id)
+        if position is None:
+            raise KeyError(card_id)
+        return self.card(position)
+
+    def get(self, card_id, default=None):
+        position = self.position(card_id)
+        return self.card(position) if position is not None else default
+
+    def items(self):
+        for position in range(len(self.ids)):
+            card = self.card(position)
+            yield card["id"], card
+
+    def to_dict(self):
+        # Same cards, in the same order, as the dict the model was built from
+        return dict(self.items())
+
+    def localized_texts(self, string_indexes, pools):
+        # string_indexes: one index per language, -1 for a missing language
+        return {language: pools[language].get(string_index) for language, string_index in zip(self.languages, string_indexes) if string_index >= 0}
+
+    def localized_property(self, property, position):
+        if property == "imagePath":
+            return self.localized_texts([self.image_paths[language][position] for language in self.languages], {language: self.urls for language in self.languages})
+        return self.localized_texts([self.localized[(property, language)][position] for language in self.languages], self.strings)
+
+    def card(self, position):
+        # The card at position, as a new dict in the shape of cards.json
+        if position in self.raw:
+            return copy.deepcopy(self.raw[position])
+        card = {
+            "id": self.shared_strings.get(self.ids[position]),
+            "type": self.types[self.type_codes[position]],
+            "subtypes": self.subtypes_at(position),
+            "assets": self.assets_at(position),
+            "mainFaction": self.factions[self.faction_codes[position]],
+            "rarity": self.rarities[self.rarity_codes[position]]
+        }
+        if self.collection[position] >= 0:
+            card.update(json.loads(self.shared_strings.get(self.collection[position])))
+        for property in TAIL_PROPERTIES[:3]:
+            card[property] = self.localized_property(property, position)
+        card["collectorNumberPrinted"] = self.shared_strings.get(self.printed[position])
+        card["elements"] = self.elements_at(position)
+        return card
+
+    def subtypes_at(self, position):
+        return [self.subtypes[code] for code in self.subtype_codes[self.subtype_offsets[position]:self.subtype_offsets[position + 1]]]
+
+    def assets_at(self, position):
+        assets = {}
+        for i in range(self.asset_offsets[position], self.asset_offsets[position + 1]):
+            assets.setdefault(self.asset_kinds[self.asset_kind_codes[i]], []).append(self.urls.get(self.asset_urls[i]))
+        return assets or []
+
+    def elements_at(self, position):
+        elements = {}
+        nb_languages = len(self.languages)
+        for i in range(self.element_offsets[position], self.element_offsets[position + 1]):
+            value_code = self.element_value_codes[i]
+            if value_code >= 0:
+                value = self.element_values[value_code]
+            else:
+                row = (-1 - value_code) * nb_languages
+                value = self.localized_texts(self.effect_texts[row:row + nb_languages], self.strings)
+            elements[self.element_keys[self.element_key_codes[i]]] = value
+        return elements
+
+    # Direct access to a property, without building the whole card
+
+    def get_property(self, card_id, property, getter):
+        position = self.position(card_id)
+        if position is None:
+            raise KeyError(card_id)
+        if position in self.raw:
+            return self.raw[position].get(property)
+        return getter(position)
+
+    def type(self, card_id):
+        return self.get_property(card_id, "type", lambda position: self.types[self.type_codes[position]])
+
+    def faction(self, card_id):
+        return self.get_property(card_id, "mainFaction", lambda position: self.factions[self.faction_codes[position]])
+
+    def rarity(self, card_id):
+        return self.get_property(card_id, "rarity", lambda position: self.rarities[self.rarity_codes[position]])
+
+    def card_subtypes(self, card_id):
+        return self.get_property(card_id, "subtypes", self.subtypes_at)
+
+    def name(self, card_id, language):
+        return self.get_property(card_id, "name", lambda position: self.localized_property("name", position)).get(language)
+
+    def elements(self, card_id):
+        return self.get_property(card_id, "elements", self.elements_at)
+
+def load_compact_cards(output_folder=OUTPUT_FOLDER):
+    # Builds the model from the results of get_cards_data.py
+    references = [load_results_json(join(output_folder, name + ".json")) for name in ["types", "subtypes", "factions", "rarities"]]
+    return CompactCards(load_results_json(join(output_folder, "cards.json")), *references)
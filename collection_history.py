@@ -0,0 +1,183 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+COLLECTION_HISTORY_FOLDER = "results/collection_history"
+CHECKPOINT_EVERY = 30 # runs between two full checkpoints of the collection
+
+# Imports
+import os
+import sys
+import json
+import bisect
+from datetime import datetime
+from os.path import join
+from utils import dump_json_atomic, load_json, create_folder_if_not_exists
+
+# Constants
+HISTORY_VERSION = 1
+COLLECTION_PROPERTIES = ["foiled", "inMyTradelist", "inMyCollection", "inMyWantlist"]
+
+def collection_state(cards):
+    # Collection stats of the cards having some, by card id
+    state = {}
+    for card_id, card in cards.items():
+        stats = {property: card[property] for property in COLLECTION_PROPERTIES if property in card}
+        if stats:
+            state[card_id] = stats
+    return state
+
+def diff_states(old_state, new_state):
+    # Per card delta: the new stats of the cards whose stats changed, None for the cards
+    # which do not have stats anymore
+    changes = {card_id: stats for card_id, stats in new_state.items() if old_state.get(card_id) != stats}
+    changes.update({card_id: None for card_id in old_state if card_id not in new_state})
+    return changes
+
+def apply_changes(state, changes):
+    for card_id, stats in changes.items():
+        if stats is None:
+            state.pop(card_id, None)
+        else:
+            state[card_id] = stats
+
+def normalize_date(date):
+    # ISO string, comparable with the dates of the runs. A day alone means the end of the day
+    if isinstance(date, datetime):
+        return date.isoformat(timespec="seconds")
+    return date + "T23:59:59" if len(date) == 10 else date
+
+class CollectionHistory:
+    # History of the collection stats, run after run. Every run appends the per card delta
+    # with the previous run to the log of the current segment; every CHECKPOINT_EVERY runs,
+    # the whole collection is written to a checkpoint and a new segment starts. The state
+    # at any run is rebuilt from a single checkpoint and the deltas of its segment:
+    #   index.json              runs (number, date, segment, number of changed cards)
+    #   checkpoint_<run>.json   collection at the run starting the segment
+    #   deltas_<run>.ndjson     one line per run of the segment: {"run", "date", "changes"}
+    def __init__(self, folder=COLLECTION_HISTORY_FOLDER, checkpoint_every=CHECKPOINT_EVERY):
+        self.folder = folder
+        self.checkpoint_every = checkpoint_every
+        index_path = join(folder, "index.json")
+        self.index = load_json(index_path) if os.path.exists(index_path) else {"version": HISTORY_VERSION, "runs": []}
+        if self.index.get("version") != HISTORY_VERSION:
+            raise ValueError(f"Unsupported collection history version in {index_path}")
+        self.runs = self.index["runs"]
+
+    def checkpoint_path(self, segment):
+        return join(self.folder, f"checkpoint_{segment}.json")
+
+    def deltas_path(self, segment):
+        return join(self.folder, f"deltas_{segment}.ndjson")
+
+    def read_deltas(self, segment, last_run):
+        # Changes of the runs of the segment up to last_run, by run. A line of a run missing
+        # from the index (interrupted run) is ignored, a run written twice keeps its last line
+        deltas = {}
+        path = self.deltas_path(segment)
+        if not os.path.exists(path):
+            return deltas
+        indexed_runs = {run["run"] for run in self.runs}
+        with open(path, encoding="utf8") as f:
+            for line in f:
+                try:
+                    delta = json.loads(line)
+                except ValueError:
+                    continue # line cut by an interruption
+                if delta["run"] <= last_run and delta["run"] in indexed_runs:
+                    deltas[delta["run"]] = delta["changes"]
+        return dict(sorted(deltas.items()))
+
+    def ends_with_cut_line(self, path):
+        # True if the last line of the log was cut by an interruption, without its line break
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return False
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def run_position(self, run):
+        runs = [one_run["run"] for one_run in self.runs]
+        position = bisect.bisect_left(runs, run)
+        if position == len(runs) or runs[position] != run:
+            raise KeyError(f"Unknown run {run}")
+        return position
+
+    def run_at(self, date):
+        # Last run made at date or before, None if there is none
+        position = bisect.bisect_right([run["date"] for run in self.runs], normalize_date(date))
+        return self.runs[position - 1]["run"] if position else None
+
+    def state_at_run(self, run):
+        # Collection stats by card id, after the given run
+        segment = self.runs[self.run_position(run)]["segment"]
+        state = load_json(self.checkpoint_path(segment))
+        for changes in self.read_deltas(segment, run).values():
+            apply_changes(state, changes)
+        return state
+
+    def state_at(self, date):
+        # Collection as of date (an ISO date string or a datetime), {} before the first run
+        run = self.run_at(date)
+        return self.state_at_run(run) if run is not None else {}
+
+    def changes_between(self, from_run, to_run):
+        # {card_id: {"before": stats, "after": stats}} for the cards whose stats differ between
+        # the two runs, None meaning no stats
+        before = self.state_at_run(from_run)
+        after = self.state_at_run(to_run)
+        return {card_id: {"before": before.get(card_id), "after": stats} for card_id, stats in sorted(diff_states(before, after).items())}
+
+    def record(self, cards, date=None):
+        # Records the collection of a run (the cards of cards.json, with their stats). Returns
+        # the run number and the number of cards whose stats changed
+        create_folder_if_not_exists(self.folder)
+        date = normalize_date(date or datetime.now())
+        state = collection_state(cards)
+        previous = self.state_at_run(self.runs[-1]["run"]) if self.runs else {}
+        changes = diff_states(previous, state)
+        run = self.runs[-1]["run"] + 1 if self.runs else 1
+        segment = self.runs[-1]["segment"] if self.runs else run
+        if run - segment >= self.checkpoint_every:
+            segment = run
+        if segment == run:
+            # Compaction: the whole collection starts a new segment
+            dump_json_atomic(state, self.checkpoint_path(segment))
+        # The delta of a checkpoint run is also logged, for the history of the changes. Applying
+        # it again to the checkpoint does not change anything, as it holds the new stats
+        deltas_path = self.deltas_path(segment)
+        with open(deltas_path, 'a', encoding="utf8") as f:
+            if self.ends_with_cut_line(deltas_path):
+                f.write("\n")
+            f.write(json.dumps({"run": run, "date": date, "changes": changes}, ensure_ascii=False) + "\n")
+        self.runs.append({"run": run, "date": date, "segment": segment, "changed": len(changes)})
+        dump_json_atomic(self.index, join(self.folder, "index.json"))
+        return run, len(changes)
+
+def parse_run(history, value):
+    # A run number, or a date for the last run made at this date or before
+    if value.isdigit():
+        return int(value)
+    run = history.run_at(value)
+    if run is None:
+        raise KeyError(f"No run before {value}")
+    return run
+
+def main():
+    # python collection_history.py                     lists the runs
+    # python collection_history.py --as-of DATE        prints the collection as of DATE (e.g. 2024-10-01)
+    # python collection_history.py --changes FROM TO   prints the changes between two runs (numbers or dates)
+    history = CollectionHistory()
+    args = sys.argv[1:]
+    if "--as-of" in args:
+        print(json.dumps(history.state_at(args[args.index("--as-of") + 1]), ensure_ascii=False, indent=4))
+    elif "--changes" in args:
+        position = args.index("--changes")
+        from_run, to_run = parse_run(history, args[position + 1]), parse_run(history, args[position + 2])
+        print(json.dumps(history.changes_between(from_run, to_run), ensure_ascii=False, indent=4))
+    else:
+        for run in history.runs:
+            print(f"Run {run['run']} ({run['date']}): {run['changed']} card(s) changed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Imports
+import os
+import json
+import shutil
+import threading
+from utils import create_folder_if_not_exists
+
+class FetchCheckpoints:
+    # Pages fetched so far, one file per (endpoint, language, faction, page), so that an
+    # interrupted fetch can be resumed. run_key describes the settings of the fetch: the
+    # pages of a previous run are only kept when resuming a run with the same settings
+    def __init__(self, folder, run_key, resume=False):
+        self.folder = folder
+        run_path = os.path.join(folder, "run.json")
+        previous_run_key = None
+        if resume:
+            try:
+                with open(run_path, encoding="utf8") as f:
+                    previous_run_key = json.load(f)
+            except (OSError, ValueError):
+                pass
+            if previous_run_key is None:
+                print("No checkpoint to resume from, starting a new fetch")
+            elif previous_run_key != run_key:
+                print("The checkpoints were made with other settings, starting a new fetch")
+        if previous_run_key != run_key:
+            self.clear()
+            create_folder_if_not_exists(folder)
+            self.write(run_path, run_key)
+
+    def faction_folder(self, endpoint, language, faction):
+        return os.path.join(self.folder, endpoint.replace("/", "_"), language, faction)
+
+    def write(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding="utf8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def save_page(self, endpoint, language, faction, page, items_per_page, total, cards):
+        folder = self.faction_folder(endpoint, language, faction)
+        os.makedirs(folder, exist_ok=True)
+        self.write(os.path.join(folder, f"page_{page}.json"), {"itemsPerPage": items_per_page, "totalItems": total, "cards": cards})
+
+    def load_pages(self, endpoint, language, faction):
+        # Returns the page size and {page: (cards, total)} for the pages 1 to n saved for the
+        # faction. A page whose number of cards does not match its hydra:totalItems (or which
+        # cannot be read) is dropped, along with the pages after it
+        folder = self.faction_folder(endpoint, language, faction)
+        pages = {}
+        items_per_page = None
+        page = 1
+        while True:
+            try:
+                with open(os.path.join(folder, f"page_{page}.json"), encoding="utf8") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                break
+            if items_per_page is None:
+                items_per_page = saved["itemsPerPage"]
+            expected = min(items_per_page, saved["totalItems"] - (page - 1) * items_per_page)
+            if saved["itemsPerPage"] != items_per_page or len(saved["cards"]) != max(0, expected):
+                print(f"Checkpoint of {endpoint} {language} {faction} page {page} is inconsistent, fetching it again")
+                break
+            pages[page] = (saved["cards"], saved["totalItems"])
+            page += 1
+        return items_per_page, pages
+
+    def complete(self, endpoint, language, faction, total):
+        self.write(os.path.join(self.faction_folder(endpoint, language, faction), "complete.json"), {"totalItems": total})
+
+    def is_complete(self, endpoint, language, faction):
+        return os.path.exists(os.path.join(self.faction_folder(endpoint, language, faction), "complete.json"))
+
+    def clear_faction(self, endpoint, language, faction):
+        shutil.rmtree(self.faction_folder(endpoint, language, faction), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -10,32 +10,78 @@ USE_COLLECTOR_NUMBERS = False
 CARDS_DATA_PATH = "results/cards.json"
 CARD_IMAGES_FOLDER = "card_images"
 CARD_ASSETS_FOLDER = "card_assets"
+MAX_WORKERS = 8 # number of parallel downloads
+MANIFEST_PATH = "card_images_manifest.json"
+REVALIDATE_AFTER = 30 * 24 * 3600 # seconds after which the files whose URL did not change are checked with the server again, 0 checks them at every run, None never
+DELETE_ORPHANS = True # delete downloaded files whose card or URL does not exist anymore
+USE_CONTENT_STORE = False # download each URL once into a content-addressed store, and link the files to it
+CONTENT_STORE_FOLDER = "card_store"
+LINK_MODE = "hardlink" # "hardlink" or "symlink", how the files are linked to the content store
 
 # Imports
 import os
-from utils import create_folder_if_not_exists, download_file, load_json
+import time
+import hashlib
+import shutil
+import threading
+from email.utils import formatdate
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import create_folder_if_not_exists, check_files_exist, fetch_file, file_sha256, load_json, load_results_json, dump_json_atomic
+import metrics
 
-def main():
-    if not DOWNLOAD_CARD_IMAGES and not DOWNLOAD_ASSETS:
-        print("Nothing to do.")
-        return
-    
-    if not os.path.exists(CARDS_DATA_PATH):
-        print(f"File {CARDS_DATA_PATH} not found. Have you run get_cards_data.py?")
-        return
-    
-    data = load_json(CARDS_DATA_PATH)
-
-    if DOWNLOAD_CARD_IMAGES:
-        create_folder_if_not_exists(CARD_IMAGES_FOLDER)
-    if DOWNLOAD_ASSETS:
-        create_folder_if_not_exists(CARD_ASSETS_FOLDER)
-    
-    nb_cards = len(data)
-    cid = 0
+# Constants
+MANIFEST_VERSION = 1
+MANIFEST_SAVE_EVERY = 500 # downloads
+
+class DownloadProgress:
+    def __init__(self, total, report_every=5):
+        self.total = total
+        self.report_every = report_every # seconds
+        self.done = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+
+    def add(self, status, size=0):
+        with self.lock:
+            self.done += 1
+            if status == "downloaded":
+                self.bytes += size
+            elif status == "not_modified":
+                self.unchanged += 1
+            else:
+                self.failed += 1
+            now = time.monotonic()
+            if now - self.last_report >= self.report_every:
+                self.last_report = now
+                print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return f"{self.done}/{self.total} files, {self.done / elapsed:.1f} files/s, {self.bytes / elapsed / 1e6:.2f} MB/s, {self.unchanged} unchanged, {self.failed} failures"
+
+def load_manifest(path=None):
+    # path defaults to MANIFEST_PATH, read at call time so that it can be changed by the callers
+    path = path or MANIFEST_PATH
+    if os.path.exists(path):
+        manifest = load_json(path)
+        if manifest.get("version") == MANIFEST_VERSION:
+            manifest.setdefault("urls", {}) # Content store entries, by source URL
+            return manifest
+        print(f"Ignoring {path}: unsupported manifest version")
+    return {"version": MANIFEST_VERSION, "files": {}, "urls": {}}
+
+def save_manifest(manifest, path=None):
+    dump_json_atomic(manifest, path or MANIFEST_PATH)
+
+def plan_files(data):
+    # List of (url, path, description) for every file of the mirror
+    files = []
+    planned_paths = set() # Several cards may share the same asset
     for card in data.values():
-        cid += 1
-        print(f"{cid}/{nb_cards}")
         card_id = card["id"]
         i = 0
 
@@ -43,17 +89,15 @@ def main():
             for language in card["imagePath"]:
                 if language not in LANGUAGES:
                     continue
-                create_folder_if_not_exists(f"{CARD_IMAGES_FOLDER}/{language}")
                 path = f"{CARD_IMAGES_FOLDER}/{language}/{card_id}.jpg"
                 if USE_COLLECTOR_NUMBERS:
                     number = card["collectorNumberFormatted"][language]
                     if "_COREKS_" in card["id"]:
                         number = number.replace("BTG", "BTGKS")
                     path = f"{CARD_IMAGES_FOLDER}/{language}/{number}.jpg"
-                if FORCE_REDOWNLOAD or not os.path.exists(path):
-                    result = download_file(card["imagePath"][language], path)
-                    if not result:
-                        print(f"Error downloading {card_id} ({language})")
+                if path not in planned_paths:
+                    planned_paths.add(path)
+                    files.append((card["imagePath"][language], path, f"{card_id} ({language})"))
 
         if "assets" in card and DOWNLOAD_ASSETS:
             for asset_type in card["assets"]:
@@ -66,11 +110,260 @@ def main():
                             file_name = f"{card_id}_XXX{i}_WEB.jpg"
                             i += 1
                             print(f"Renaming to {file_name}")
-                    create_folder_if_not_exists(f"{CARD_ASSETS_FOLDER}/{asset_type}")
                     path = f"{CARD_ASSETS_FOLDER}/{asset_type}/{file_name}"
+                    if path not in planned_paths:
+                        planned_paths.add(path)
+                        files.append((asset_url, path, f"{asset_type}/{file_name} ({card_id})"))
+    return files
+
+def revalidation_due(entry, now):
+    # A new image gets a new URL in the cards data, so the files whose URL did not change are
+    # kept as is, and only checked with the server every REVALIDATE_AFTER seconds
+    return REVALIDATE_AFTER is not None and now - entry.get("checked_at", 0) >= REVALIDATE_AFTER
+
+def card_urls(data):
+    # Every image and asset URL of the cards, whatever the parameters
+    urls = set()
+    for card in data.values():
+        urls.update((card.get("imagePath") or {}).values())
+        for asset_urls in (card.get("assets") or {}).values():
+            urls.update(asset_urls)
+    return urls
+
+def plan_downloads(files, manifest):
+    # Splits the files between full downloads, conditional requests and files to keep as is
+    now = time.time()
+    downloads = []
+    revalidations = []
+    unchanged = 0
+    for url, path, description in files:
+        entry = manifest["files"].get(path)
+        exists = os.path.exists(path)
+        if entry is None and exists and not FORCE_REDOWNLOAD:
+            # File downloaded before the manifest existed: adopt it, and let the server
+            # tell whether it changed since it was written
+            entry = {
+                "url": url,
+                "etag": None,
+                "last_modified": formatdate(os.path.getmtime(path), usegmt=True),
+                "size": os.path.getsize(path),
+                "sha256": file_sha256(path),
+                "checked_at": 0 # never checked with the server
+            }
+            manifest["files"][path] = entry
+        if FORCE_REDOWNLOAD or entry is None or entry["url"] != url or not exists or os.path.getsize(path) != entry["size"]:
+            downloads.append((url, path, description, None))
+        elif revalidation_due(entry, now):
+            revalidations.append((url, path, description, entry))
+        else:
+            unchanged += 1
+    return downloads, revalidations, unchanged
+
+def remove_orphans(files, manifest, urls):
+    # Files of cards or URLs that do not exist anymore (urls: the URLs of the cards data), and
+    # files whose URL is now downloaded to another path. The files left out by the parameters
+    # (languages, assets...) are kept
+    planned_paths = {path for _, path, _ in files}
+    planned_urls = {url for url, _, _ in files}
+    orphans = [path for path, entry in manifest["files"].items() if path not in planned_paths and (entry["url"] not in urls or entry["url"] in planned_urls)]
+    for path in orphans:
+        if os.path.exists(path):
+            os.remove(path)
+        del manifest["files"][path]
+    return len(orphans)
+
+def record_file(manifest, url, path, info):
+    manifest["files"][path] = {"url": url, **info}
+
+def download_all(jobs, manifest, max_workers=MAX_WORKERS, record=record_file):
+    for folder in sorted({os.path.dirname(path) for _, path, _, _ in jobs}):
+        create_folder_if_not_exists(folder)
+
+    progress = DownloadProgress(len(jobs))
+    def download(job):
+        url, path, description, entry = job
+        if entry is None:
+            status, info = fetch_file(url, path)
+        else:
+            status, info = fetch_file(url, path, etag=entry["etag"], last_modified=entry["last_modified"])
+        if status == "failed":
+            print(f"Error downloading {description}")
+        elif info is not None:
+            info["checked_at"] = time.time()
+        metrics.increment(f"files_{status}")
+        progress.add(status, info["size"] if info else 0)
+        return url, path, status, info, entry
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download, job) for job in jobs]
+        try:
+            for nb_done, future in enumerate(as_completed(futures), 1):
+                url, path, status, info, entry = future.result()
+                if info is not None:
+                    record(manifest, url, path, info)
+                elif status == "not_modified":
+                    entry["checked_at"] = time.time()
+                if nb_done % MANIFEST_SAVE_EVERY == 0:
+                    save_manifest(manifest)
+        finally:
+            # Keep what was downloaded so far, even if the run is interrupted
+            save_manifest(manifest)
+    print(progress.summary())
+    return progress
+
+def blob_path(sha256):
+    return f"{CONTENT_STORE_FOLDER}/{sha256[:2]}/{sha256}"
+
+def url_download_path(url):
+    return f"{CONTENT_STORE_FOLDER}/tmp/{hashlib.sha256(url.encode('utf8')).hexdigest()}"
+
+def record_blob(manifest, url, path, info):
+    # Moves a downloaded file into the store, where identical contents are kept only once
+    target = blob_path(info["sha256"])
+    create_folder_if_not_exists(os.path.dirname(target))
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.replace(path, target)
+    manifest["urls"][url] = info
+
+def link_file(source, path):
+    if os.path.lexists(path):
+        if LINK_MODE == "symlink" and os.path.islink(path) and os.readlink(path) == os.path.relpath(source, os.path.dirname(path)):
+            return False
+        if LINK_MODE != "symlink" and not os.path.islink(path) and os.path.samefile(source, path):
+            return False
+    tmp_path = path + ".part"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    if LINK_MODE == "symlink":
+        os.symlink(os.path.relpath(source, os.path.dirname(path)), tmp_path)
+    else:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path) # e.g. the store is on another file system
+    os.replace(tmp_path, path)
+    return True
+
+def adopt_file(manifest, url, paths):
+    # Turns a file of the mirror downloaded from url (e.g. before USE_CONTENT_STORE was set) into
+    # the blob of the URL, if its content still matches its SHA-256. Returns True if one was adopted
+    for path in paths:
+        entry = manifest["files"][path]
+        if not os.path.isfile(path) or os.path.getsize(path) != entry["size"] or file_sha256(path) != entry["sha256"]:
+            continue
+        target = blob_path(entry["sha256"])
+        if not os.path.exists(target):
+            create_folder_if_not_exists(os.path.dirname(target))
+            tmp_path = target + ".part"
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        manifest["urls"][url] = {name: value for name, value in entry.items() if name != "url"}
+        return True
+    return False
+
+def remove_unused_blobs(manifest):
+    used = {entry["sha256"] for entry in manifest["urls"].values()}
+    removed = 0
+    if not os.path.exists(CONTENT_STORE_FOLDER):
+        return removed
+    for folder in os.listdir(CONTENT_STORE_FOLDER):
+        if folder == "tmp":
+            continue
+        for sha256 in os.listdir(f"{CONTENT_STORE_FOLDER}/{folder}"):
+            if sha256 not in used:
+                os.remove(f"{CONTENT_STORE_FOLDER}/{folder}/{sha256}")
+                removed += 1
+    return removed
+
+def sync_content_store(files, manifest, urls):
+    # Each unique URL is downloaded once into the store, then every file of the
+    # mirror is linked to the content of its URL
+    now = time.time()
+    jobs = []
+    unchanged = 0
+    adopted = 0
+    planned_urls = {}
+    for url, path, description in files:
+        planned_urls.setdefault(url, description)
+    paths_by_url = {}
+    for path, entry in manifest["files"].items():
+        paths_by_url.setdefault(entry["url"], []).append(path)
+    for url, description in planned_urls.items():
+        entry = manifest["urls"].get(url)
+        if not FORCE_REDOWNLOAD and (entry is None or not os.path.exists(blob_path(entry["sha256"]))) and adopt_file(manifest, url, paths_by_url.get(url, [])):
+            adopted += 1
+            entry = manifest["urls"][url]
+        if FORCE_REDOWNLOAD or entry is None or not os.path.exists(blob_path(entry["sha256"])):
+            jobs.append((url, url_download_path(url), description, None))
+        elif revalidation_due(entry, now):
+            jobs.append((url, url_download_path(url), description, entry))
+        else:
+            unchanged += 1
+    orphans = 0
+    if DELETE_ORPHANS:
+        orphans = remove_orphans(files, manifest, urls)
+        for url in [url for url in manifest["urls"] if url not in urls]:
+            del manifest["urls"][url]
+    metrics.increment("files_skipped", unchanged)
+    metrics.increment("files_adopted", adopted)
+    metrics.increment("files_orphaned", orphans)
+    print(f"{len(files)} files, {len(planned_urls)} unique URLs: {sum(1 for job in jobs if job[3] is None)} to download, {sum(1 for job in jobs if job[3] is not None)} to revalidate, {unchanged} unchanged ({adopted} adopted from the mirror), {orphans} orphans removed")
+    with metrics.timer("download"):
+        progress = download_all(jobs, manifest, record=record_blob)
+
+    for folder in sorted({os.path.dirname(path) for _, path, _ in files}):
+        create_folder_if_not_exists(folder)
+    linked = 0
+    with metrics.timer("link"):
+        for url, path, description in files:
+            if url not in manifest["urls"]:
+                continue # Download failed
+            entry = manifest["urls"][url]
+            if link_file(blob_path(entry["sha256"]), path):
+                linked += 1
+            manifest["files"][path] = {"url": url, **entry}
+    save_manifest(manifest)
+    blobs_removed = remove_unused_blobs(manifest) if DELETE_ORPHANS else 0
+    print(f"{linked} files linked, {blobs_removed} unused blobs removed")
+    return progress.failed
+
+def download_images(data):
+    # Downloads the images of the cards data, and the assets, according to the parameters.
+    # Returns the number of files that could not be downloaded
+    with metrics.timer("load"):
+        manifest = load_manifest()
+    files = plan_files(data)
+    urls = card_urls(data)
+    if USE_CONTENT_STORE:
+        return sync_content_store(files, manifest, urls)
+    with metrics.timer("plan"):
+        downloads, revalidations, unchanged = plan_downloads(files, manifest)
+        orphans = 0
+        if DELETE_ORPHANS:
+            orphans = remove_orphans(files, manifest, urls)
+    metrics.increment("files_skipped", unchanged)
+    metrics.increment("files_orphaned", orphans)
+    print(f"{len(files)} files: {len(downloads)} to download, {len(revalidations)} to revalidate, {unchanged} unchanged, {orphans} orphans removed")
+    with metrics.timer("download"):
+        progress = download_all(downloads + revalidations, manifest)
+    return progress.failed
+
+def main():
+    if not DOWNLOAD_CARD_IMAGES and not DOWNLOAD_ASSETS:
+        print("Nothing to do.")
+        return
+
+    if not check_files_exist([CARDS_DATA_PATH]):
+        return
 
-                    if FORCE_REDOWNLOAD or not os.path.exists(path):
-                        download_file(asset_url, path)
+    with metrics.timer("load"):
+        data = load_results_json(CARDS_DATA_PATH)
+    download_images(data)
 
 if __name__ == "__main__":
-    main()
+    metrics.run_instrumented("get_card_images", main)
@@ -13,21 +13,52 @@ FORCE_INCLUDE_KS_UNIQUES = False # only relevant if INCLUDE_KS = False and INCLU
 INCLUDE_FOILERS = False
 SKIP_NOT_ALL_LANGUAGES = False
 COLLECTION_TOKEN=None
+API_URL = "https://api.altered.gg" # e.g. the URL of mock_api_server.py for offline runs
+PAGE_SIZE = 1000 # cards requested per page, reduced to the largest page size the API accepts
+MAX_WORKERS = 1 # number of pages fetched in parallel, 1 fetches everything sequentially
+HTTP_CACHE_FOLDER = None # e.g. "cache" to keep the API responses on disk between runs
+HTTP_CACHE_TTL = 3600 # seconds during which a cached page is used without asking the API
+HTTP_CACHE_MAX_SIZE = 512 * 1024 * 1024 # bytes, least recently used pages are evicted above this
+STREAMING_MODE = False # bounded memory mode for very large catalogs (e.g. with uniques)
+STREAM_CHUNK_SIZE = 20000 # cards kept in memory per language before being spilled to disk, in streaming mode
+WRITE_NDJSON = False # in streaming mode, also write the cards as NDJSON (one card per line)
+WRITE_SNAPSHOTS = False # also write a binary snapshot of each result, loaded much faster by the other scripts
+MERGE_REPORT_SAMPLES = 20 # occurrences of each kind of merge conflict kept in results/merge_report.json
+CHECKPOINT_FOLDER = "temp/checkpoints" # the fetched pages are saved there until the end of the run, None disables it
+RESUME = False # resume the fetch of an interrupted run from its checkpoints, same as the --resume argument
+RECORD_COLLECTION_HISTORY = True # with COLLECTION_TOKEN, the changes of the collection are recorded at each run, see collection_history.py
 
 # Imports
-import requests
+import sys
+import json
+import heapq
+import hashlib
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict, List
 from os.path import join
-from utils import dump_json, create_folder_if_not_exists, LANGUAGE_HEADERS
+from utils import dump_json, load_results_json, create_folder_if_not_exists, http_get, JsonObjectWriter, LANGUAGE_HEADERS
+from http_cache import HttpCache
+from fetch_checkpoints import FetchCheckpoints
+from collection_history import CollectionHistory
+import metrics
 
 # Constants
-ITEMS_PER_PAGE = 36
+ITEMS_PER_PAGE = 36 # page size of the website, always accepted by the API
+FACTIONS = ["AX", "BR", "LY", "MU", "OR", "YZ", "NE"]
 
-def get_page(apiEndpoint, language, page, faction=None, include_uniques=INCLUDE_UNIQUES, items_per_page=ITEMS_PER_PAGE, collection_token=None):
+class ApiError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+def get_page(apiEndpoint, language, page, faction=None, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, http_cache=None, refresh=False):
+    # refresh skips the TTL of the cache, the cached page is only used if the API answers 304
     rarity_params = "rarity[]=UNIQUE&rarity[]=COMMON&rarity[]=RARE"
     if not include_uniques:
         rarity_params = "rarity[]=COMMON&rarity[]=RARE"
-    url = f"https://api.altered.gg/{apiEndpoint}?{rarity_params}&itemsPerPage={items_per_page}&page={page}"
+    url = f"{API_URL}/{apiEndpoint}?{rarity_params}&itemsPerPage={items_per_page}&page={page}"
     headers = {}
     headers.update(LANGUAGE_HEADERS[language])
     if collection_token:
@@ -35,23 +66,41 @@ def get_page(apiEndpoint, language, page, faction=None, include_uniques=INCLUDE_
         url += f"&collection=true"
     if faction is not None:
         url += f"&factions[]={faction}"
-    attempts = 0
-    response = None
-    while not response:
-        attempts += 1
-        if attempts > 1:
-            print(f"Error ({url}). Retrying (attempt {attempts})...")
-        try:
-            response = requests.get(url, headers=headers)
-        except:
-            if attempts >= 5:
-                raise
-        if attempts >= 5:
-            raise Exception("Didn't work after 5 attempts")
-    if not response.ok:
-        print(response)
-        raise Exception("Request error." + (" Is your token up to date?" if collection_token else ""))
-    data = response.json()
+    cache_key = None
+    cache_entry = None
+    if http_cache is not None:
+        cache_key = {
+            "endpoint": apiEndpoint,
+            "language": language,
+            "faction": faction,
+            "page": page,
+            "rarity": rarity_params,
+            "itemsPerPage": items_per_page,
+            # Collection pages are specific to the user, only a hash of the token is stored
+            "collection": hashlib.sha256(collection_token.encode("utf8")).hexdigest() if collection_token else None
+        }
+        cache_entry = http_cache.get(cache_key)
+    if cache_entry is not None and http_cache.is_fresh(cache_entry) and not refresh:
+        metrics.increment("http_cache_hits")
+        data = cache_entry["body"]
+    else:
+        if cache_entry is not None:
+            headers.update(http_cache.conditional_headers(cache_entry))
+        response = http_get(url, headers=headers)
+        if response.status_code == 304 and cache_entry is not None:
+            metrics.increment("http_cache_revalidated")
+            http_cache.refresh(cache_key, cache_entry)
+            data = cache_entry["body"]
+        else:
+            if not response.ok:
+                print(response)
+                raise ApiError("Request error." + (" Is your token up to date?" if collection_token else ""), response.status_code)
+            if http_cache is not None:
+                metrics.increment("http_cache_misses")
+            with metrics.timer("json_parse"):
+                data = response.json()
+            if http_cache is not None:
+                http_cache.put(cache_key, data, etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
     cards = data["hydra:member"]
     if apiEndpoint == "cards":
         fix_api_errors(cards)
@@ -69,72 +118,252 @@ def fix_api_errors(cards):
         if id.startswith("ALT_COREKS_B_LY_10_"): # Ouroboros Inkcaster KS
             card["collectorNumberFormatted"] = cn.replace("BTG-065", "BTG-074")
 
-def get_data_language_faction(apiEndpoint, language, faction, include_uniques=INCLUDE_UNIQUES, items_per_page=ITEMS_PER_PAGE, collection_token=None):
-    print("  page 1")
-    data, page1_total = get_page(apiEndpoint, language, 1, faction=faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
-    if data is None:
-        return None
-    nb_pages = (page1_total - 1)//ITEMS_PER_PAGE + 1
-    for i in range(2, nb_pages+1):
-        print(f"  page {i}/{nb_pages}")
-        page_data, page_total = get_page(apiEndpoint, language, i, faction=faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
-        if page_total != page1_total:
-            print("Restarting because the total number of cards changed")
-            return get_data_language_faction(language, faction, collection_token=collection_token)
-        data += page_data
-    
-    if len(data) != page1_total:
-        raise Exception(f"Error: total ({page1_total}) is different compared to number of cards ({len(data)})")
-    
+def get_first_page(apiEndpoint, language, faction, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, http_cache=None):
+    # Fetches page 1 with the largest page size accepted by the API, starting from items_per_page.
+    # A refused page size is halved, and a page size silently capped by the API is detected from
+    # the number of cards returned. Returns the cards, the total and the page size to use
+    while True:
+        try:
+            page_data, total = get_page(apiEndpoint, language, 1, faction=faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache)
+        except ApiError as e:
+            if e.status_code not in [400, 422] or items_per_page <= ITEMS_PER_PAGE:
+                raise
+            items_per_page = max(ITEMS_PER_PAGE, items_per_page // 2)
+            print(f"Page size refused by the API, trying {items_per_page}")
+            continue
+        if len(page_data) < min(items_per_page, total):
+            if not page_data:
+                raise Exception(f"Error: no cards on page 1 while the total is {total}")
+            items_per_page = len(page_data)
+        return page_data, total, items_per_page
+
+def get_nb_pages(total, items_per_page):
+    return max(1, (total - 1)//items_per_page + 1)
+
+def dedupe_cards(pages_data):
+    # Cards of consecutive pages, without the ones seen twice because they moved from a page
+    # to the next while paginating. The first position and the last version of a card are kept
+    cards = {}
+    for page_data in pages_data:
+        for card in page_data:
+            cards[card["reference"]] = card
+    return list(cards.values())
+
+def iter_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=None):
+    # Yields (page, cards, total) for each page of the faction. When the total changes mid-walk,
+    # the pages already fetched are fetched again backwards until one is unchanged: the pages
+    # before it are not affected by the change. A page can then be yielded several times.
+    # With checkpoints, the walk starts after the pages saved by a previous run
+    def fetch(page, refresh=False):
+        page_data, page_total = get_page(apiEndpoint, language, page, faction=faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, refresh=refresh)
+        if checkpoints is not None:
+            checkpoints.save_page(apiEndpoint, language, faction, page, items_per_page, page_total, page_data)
+        return page_data, page_total
+
+    saved_pages = {}
+    if checkpoints is not None:
+        saved_items_per_page, saved_pages = checkpoints.load_pages(apiEndpoint, language, faction)
+    if saved_pages:
+        items_per_page = saved_items_per_page
+        print(f"  {len(saved_pages)} page(s) loaded from the checkpoints")
+        references = {}
+        for page, (page_data, total) in saved_pages.items():
+            references[page] = [card["reference"] for card in page_data]
+            yield page, page_data, total
+        if checkpoints.is_complete(apiEndpoint, language, faction):
+            return
+        page = max(saved_pages) + 1
+    else:
+        print("  page 1")
+        page_data, total, items_per_page = get_first_page(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache)
+        if checkpoints is not None:
+            checkpoints.save_page(apiEndpoint, language, faction, 1, items_per_page, total, page_data)
+        references = {1: [card["reference"] for card in page_data]}
+        yield 1, page_data, total
+        page = 2
+    nb_pages = get_nb_pages(total, items_per_page)
+    while page <= nb_pages:
+        print(f"  page {page}/{nb_pages}")
+        page_data, page_total = fetch(page)
+        references[page] = [card["reference"] for card in page_data]
+        yield page, page_data, page_total
+        if page_total != total:
+            print(f"The total number of cards changed ({total} -> {page_total}), fetching the previous pages again")
+            total = page_total
+            for previous_page in range(page - 1, 0, -1):
+                print(f"  page {previous_page}/{nb_pages} (again)")
+                page_data, total = fetch(previous_page, refresh=True)
+                page_references = [card["reference"] for card in page_data]
+                if page_references == references[previous_page]:
+                    break
+                references[previous_page] = page_references
+                yield previous_page, page_data, total
+            nb_pages = get_nb_pages(total, items_per_page)
+        page += 1
+    if checkpoints is not None:
+        checkpoints.complete(apiEndpoint, language, faction, total)
+
+def walk_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=None):
+    # Returns the cards of the last version of each page, and the last total
+    pages_data = {}
+    total = None
+    for page, page_data, total in iter_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=checkpoints):
+        pages_data[page] = page_data
+    return dedupe_cards(pages_data[page] for page in sorted(pages_data)), total
+
+def get_data_language_faction(apiEndpoint, language, faction, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, http_cache=None, checkpoints=None):
+    data, total = walk_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=checkpoints)
+    if len(data) != total:
+        print(f"The number of cards ({len(data)}) does not match the total ({total}), fetching the faction again")
+        if checkpoints is not None:
+            checkpoints.clear_faction(apiEndpoint, language, faction)
+        data, total = walk_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=checkpoints)
+    if len(data) != total:
+        raise Exception(f"Error: total ({total}) is different compared to number of cards ({len(data)})")
     return data
 
-def get_data_language(apiEndpoint, language, include_uniques=INCLUDE_UNIQUES, items_per_page=ITEMS_PER_PAGE, collection_token=None):
+def get_data_language(apiEndpoint, language, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, http_cache=None, checkpoints=None):
     data = []
-    for faction in ["AX", "BR", "LY", "MU", "OR", "YZ", "NE"]:
+    for faction in FACTIONS:
         print(f"==== Faction {faction} ====")
-        data += get_data_language_faction(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
+        data += get_data_language_faction(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, checkpoints=checkpoints)
+    return data
+
+def get_data_languages_concurrent(apiEndpoint, languages, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, max_workers=MAX_WORKERS, http_cache=None, checkpoints=None):
+    # Fetches every (language, faction, page) in a thread pool, and returns the same lists as get_data_language for each language
+    page_sizes = {}
+    def fetch(language, faction, page, refresh=False):
+        if page == 1 and (language, faction) not in page_sizes:
+            page_data, page_total, page_size = get_first_page(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache)
+        else:
+            page_size = page_sizes[(language, faction)]
+            page_data, page_total = get_page(apiEndpoint, language, page, faction=faction, include_uniques=include_uniques, items_per_page=page_size, collection_token=collection_token, http_cache=http_cache, refresh=refresh)
+        if checkpoints is not None:
+            checkpoints.save_page(apiEndpoint, language, faction, page, page_size, page_total, page_data)
+        return page_data, page_total, page_size
+
+    pages = {}
+    page_totals = {}
+    latest_totals = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        pending = {}
+        for language in languages:
+            for faction in FACTIONS:
+                saved_pages = {}
+                if checkpoints is not None:
+                    page_size, saved_pages = checkpoints.load_pages(apiEndpoint, language, faction)
+                if not saved_pages:
+                    pending[executor.submit(fetch, language, faction, 1)] = (language, faction, 1)
+                    continue
+                page_sizes[(language, faction)] = page_size
+                for page, (page_data, page_total) in saved_pages.items():
+                    pages[(language, faction, page)] = page_data
+                    page_totals[(language, faction, page)] = page_total
+                    latest_totals[(language, faction)] = page_total
+                if not checkpoints.is_complete(apiEndpoint, language, faction):
+                    for i in range(max(saved_pages) + 1, get_nb_pages(latest_totals[(language, faction)], page_size) + 1):
+                        pending[executor.submit(fetch, language, faction, i)] = (language, faction, i)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                language, faction, page = pending.pop(future)
+                page_data, page_total, page_size = future.result()
+                if page == 1:
+                    page_sizes[(language, faction)] = page_size
+                    nb_pages = get_nb_pages(page_total, page_size)
+                    print(f"  {language} {faction}: {nb_pages} page(s) of {page_size} cards")
+                    # Once the total is known, the remaining pages of the faction can be scheduled
+                    for i in range(2, nb_pages+1):
+                        pending[executor.submit(fetch, language, faction, i)] = (language, faction, i)
+                pages[(language, faction, page)] = page_data
+                page_totals[(language, faction, page)] = page_total
+                latest_totals[(language, faction)] = page_total
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    # Put the pages back in the same order as the sequential path
+    data = {}
+    for language in languages:
+        data[language] = []
+        for faction in FACTIONS:
+            total = latest_totals[(language, faction)]
+            page_size = page_sizes[(language, faction)]
+            # Pages fetched before the total changed, or missing because it grew, are fetched again
+            stale_pages = [i for i in range(1, get_nb_pages(total, page_size) + 1) if page_totals.get((language, faction, i)) != total]
+            if stale_pages:
+                print(f"The total number of cards changed for {language} {faction}, fetching pages {', '.join(map(str, stale_pages))} again")
+            for i in stale_pages:
+                pages[(language, faction, i)], total, _ = fetch(language, faction, i, refresh=True)
+            faction_data = dedupe_cards(pages[(language, faction, i)] for i in range(1, get_nb_pages(total, page_size) + 1) if (language, faction, i) in pages)
+            if len(faction_data) != total:
+                print(f"The number of cards does not match the total for {language} {faction}, fetching it again sequentially")
+                if checkpoints is not None:
+                    checkpoints.clear_faction(apiEndpoint, language, faction)
+                faction_data = get_data_language_faction(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, checkpoints=checkpoints)
+            elif checkpoints is not None:
+                checkpoints.complete(apiEndpoint, language, faction, total)
+            data[language] += faction_data
     return data
 
-def treat_cards_data(cards_data, stats_data, include_uniques, include_ks, include_promo_cards, include_foilers, force_include_ks_uniques):
+def index_stats_data(stats_data):
+    # Collection stats by card reference, so they can be joined to the cards in constant time
+    stats_index = {}
+    for stats in stats_data:
+        card_stats = stats_index.setdefault(stats["reference"], {})
+        for optional_property in ["inMyCollection", "inMyWantlist", "foiled", "inMyTradelist"]:
+            if optional_property in stats:
+                card_stats[optional_property] = stats[optional_property]
+    return stats_index
+
+def treat_card(card, stats_index, include_uniques, include_ks, include_promo_cards, include_foilers, force_include_ks_uniques):
+    if not include_foilers and "_FOILER_" in card["reference"]:
+        metrics.increment("skipped_foiler_cards")
+        return None
+    if not include_ks and "_COREKS_" in card["reference"]:
+        if not include_uniques or not force_include_ks_uniques or "_U_" not in card["reference"]:
+            metrics.increment("skipped_ks_cards")
+            return None
+    if not include_promo_cards and card["reference"].startswith("ALT_CORE_P_"):
+        # print(f"Skipping promo card {card['reference']}")
+        metrics.increment("skipped_promo_cards")
+        return None # Promo card with missing stats
+    cdata = {
+        "id": card["reference"],
+        "name": card["name"],
+        "type": card["cardType"]["reference"],
+        "subtypes": [subtype["reference"] for subtype in card["cardSubTypes"]] if "cardSubTypes" in card else [],
+        "imagePath": card["imagePath"],
+        "assets": card["assets"] if "assets" in card else [],
+        "mainFaction": card["mainFaction"]["reference"],
+        "elements": card["elements"],
+        "rarity": card["rarity"]["reference"],
+        "collectorNumberFormatted": card["collectorNumberFormatted"]
+    }
+    if card["reference"] in stats_index:
+        cdata.update(stats_index[card["reference"]])
+    return cdata
+
+def add_card_references(card, types, subtypes, factions, rarities):
+    types[card["cardType"]["reference"]] = card["cardType"]["name"]
+    if "cardSubTypes" in card:
+        for subtype in card["cardSubTypes"]:
+            subtypes[subtype["reference"]] = subtype["name"]
+    factions[card["mainFaction"]["reference"]] = card["mainFaction"]["name"]
+    rarities[card["rarity"]["reference"]] = card["rarity"]["name"]
+
+def treat_cards_data(cards_data, stats_index, include_uniques, include_ks, include_promo_cards, include_foilers, force_include_ks_uniques):
     cards = []
     types = {}
     subtypes = {}
     factions = {}
     rarities = {}
     for card in cards_data:
-        if not include_foilers and "_FOILER_" in card["reference"]:
+        cdata = treat_card(card, stats_index, include_uniques, include_ks, include_promo_cards, include_foilers, force_include_ks_uniques)
+        if cdata is None:
             continue
-        if not include_ks and "_COREKS_" in card["reference"]:
-            if not include_uniques or not force_include_ks_uniques or "_U_" not in card["reference"]:
-                continue
-        if not include_promo_cards and card["reference"].startswith("ALT_CORE_P_"):
-            # print(f"Skipping promo card {card['reference']}")
-            continue # Promo card with missing stats
-        cdata = {
-            "id": card["reference"],
-            "name": card["name"],
-            "type": card["cardType"]["reference"],
-            "subtypes": [subtype["reference"] for subtype in card["cardSubTypes"]] if "cardSubTypes" in card else [],
-            "imagePath": card["imagePath"],
-            "assets": card["assets"] if "assets" in card else [],
-            "mainFaction": card["mainFaction"]["reference"],
-            "elements": card["elements"],
-            "rarity": card["rarity"]["reference"],
-            "collectorNumberFormatted": card["collectorNumberFormatted"]
-        }
-        for stats in stats_data:
-            if stats["reference"] == card["reference"]:
-                for optional_property in ["inMyCollection", "inMyWantlist", "foiled", "inMyTradelist"]:
-                    if optional_property in stats:
-                        cdata[optional_property] = stats[optional_property]
         cards.append(cdata)
-
-        types[card["cardType"]["reference"]] = card["cardType"]["name"]
-        if "cardSubTypes" in card:
-            for subtype in card["cardSubTypes"]:
-                subtypes[subtype["reference"]] = subtype["name"]
-        factions[card["mainFaction"]["reference"]] = card["mainFaction"]["name"]
-        rarities[card["rarity"]["reference"]] = card["rarity"]["name"]
+        add_card_references(card, types, subtypes, factions, rarities)
     return cards, types, subtypes, factions, rarities
 
 def merge_language_dicts(data: Dict[str, Dict[str, any]]):
@@ -146,67 +375,151 @@ def merge_language_dicts(data: Dict[str, Dict[str, any]]):
             merged_dict[key][language] = data[language][key]
     return merged_dict
 
-def merge_cards_data(data: Dict[str, List[Dict[str, any]]], skip_not_all_languages, is_collection):
-    cards_lang_dict = {}
-    all_cards_ids = set()
-    for language in data:
-        cards_lang_dict[language] = {}
+class MergeReport:
+    # Conflicts found while merging the languages of the cards: counts by kind and detail
+    # (language or property), and the first few occurrences of each kind
+    def __init__(self, max_samples=MERGE_REPORT_SAMPLES):
+        self.max_samples = max_samples
+        self.kinds = {}
+
+    def add(self, kind, card_id, detail, **values):
+        entry = self.kinds.get(kind)
+        if entry is None:
+            entry = self.kinds[kind] = {"count": 0, "details": {}, "samples": []}
+        entry["count"] += 1
+        entry["details"][detail] = entry["details"].get(detail, 0) + 1
+        if len(entry["samples"]) < self.max_samples:
+            entry["samples"].append({"id": card_id, "detail": detail, **values})
+
+    def total(self):
+        return sum(entry["count"] for entry in self.kinds.values())
+
+    def summary(self):
+        if not self.kinds:
+            return "No merge conflicts"
+        return "Merge conflicts: " + ", ".join(f"{entry['count']} {kind}" for kind, entry in self.kinds.items())
+
+    def write(self, filename):
+        dump_json({"total": self.total(), "kinds": self.kinds}, filename)
+
+# Properties compared across the languages, and element properties by kind: localized texts,
+# values where "" means None, and integers
+SAME_PROPERTIES = ["id", "type", "subtypes", "assets", "mainFaction", "rarity"]
+SAME_PROPERTIES_COLLECTION = SAME_PROPERTIES + ["foiled", "inMyTradelist", "inMyCollection", "inMyWantlist"]
+LOCALIZED_PROPERTIES = ["name", "imagePath", "collectorNumberFormatted"]
+_element_kinds = {}
+
+def get_element_kind(property):
+    kind = _element_kinds.get(property)
+    if kind is None:
+        if "EFFECT" in property:
+            kind = "localized"
+        elif property in ["PERMANENT", "RESERVE"]:
+            kind = "int"
+        elif "COST" in property or "POWER" in property:
+            kind = "optional"
+        else:
+            kind = "raw"
+        _element_kinds[property] = kind
+    return kind
+
+def merge_cards_data(data: Dict[str, List[Dict[str, any]]], skip_not_all_languages, is_collection, report=None):
+    # Single keyed pass over the cards of every language, then each card is merged
+    languages = list(data)
+    versions_by_id = {}
+    for language_index, language in enumerate(languages):
         for card in data[language]:
-            cards_lang_dict[language][card["id"]] = card
-            all_cards_ids.add(card["id"])
-    
+            versions = versions_by_id.get(card["id"])
+            if versions is None:
+                versions = versions_by_id[card["id"]] = [None] * len(languages)
+            versions[language_index] = card
+
     all_cards = {}
-    for card_id in all_cards_ids:
-        card = {}
-        for language in data:
-            if card_id not in cards_lang_dict[language]:
-                print(f"Card {card_id} not found in {language}")
-                if skip_not_all_languages:
-                    print("Skipping card")
-                    break
-                continue
-            current_card_lang = cards_lang_dict[language][card_id]
-            same_properties = ["id", "type", "subtypes", "assets", "mainFaction", "rarity"]
-            if is_collection:
-                same_properties.extend(["foiled", "inMyTradelist", "inMyCollection", "inMyWantlist"])
-            for property in same_properties:
-                if property not in current_card_lang:
-                    print(f"Property {property} not in card {current_card_lang['name']}")
-                    continue
-                add_property_or_ensure_identical(card, property, current_card_lang[property])
-            for property in ["name", "imagePath", "collectorNumberFormatted"]:
-                if property not in card:
-                    card[property] = {}
-                card[property][language] = current_card_lang[property]
-            collector_number_printed: str = current_card_lang["collectorNumberFormatted"]
-            if collector_number_printed[-2:].isalpha():
-                collector_number_printed = collector_number_printed[:-3]
-            add_property_or_ensure_identical(card, "collectorNumberPrinted", collector_number_printed)
-            if "elements" not in card:
-                card["elements"] = {}
-            for property in current_card_lang["elements"]:
-                if "EFFECT" in property:
-                    if property not in card["elements"]:
-                        card["elements"][property] = {}
-                    card["elements"][property][language] = current_card_lang["elements"][property]
-                else:
-                    value = current_card_lang["elements"][property]
-                    if "COST" in property or "POWER" in property:
-                        value = value if value != "" else None
-                    if property in ["PERMANENT", "RESERVE"]:
-                        value = int(value) if value != "" else None
-                    add_property_or_ensure_identical(card["elements"], property, value)
-        else: # Execute when the for loop is done, except if break
+    for card_id, versions in versions_by_id.items():
+        card = merge_card_versions(card_id, languages, versions, skip_not_all_languages, is_collection, report)
+        if card is not None:
             all_cards[card_id] = card
     return all_cards
 
-def add_property_or_ensure_identical(card, property_name, property_value):
+def merge_card_versions(card_id, languages, versions, skip_not_all_languages, is_collection, report=None):
+    # Merges the versions of a card (None if missing) in each language, in the same order as
+    # languages. Returns None if the card is skipped. The conflicts are added to report (if any)
+    same_properties = SAME_PROPERTIES_COLLECTION if is_collection else SAME_PROPERTIES
+    card = {}
+    elements = None
+    for language, current_card_lang in zip(languages, versions):
+        if current_card_lang is None:
+            if report is not None:
+                report.add("missing_language", card_id, language)
+            if skip_not_all_languages:
+                if report is not None:
+                    report.add("skipped_card", card_id, language)
+                return None
+            continue
+        for property in same_properties:
+            if property not in current_card_lang:
+                if report is not None:
+                    report.add("missing_property", card_id, property, language=language)
+                continue
+            add_property_or_ensure_identical(card, property, current_card_lang[property], card_id, report)
+        for property in LOCALIZED_PROPERTIES:
+            if property not in card:
+                card[property] = {}
+            card[property][language] = current_card_lang[property]
+        collector_number_printed: str = current_card_lang["collectorNumberFormatted"]
+        if collector_number_printed[-2:].isalpha():
+            collector_number_printed = collector_number_printed[:-3]
+        add_property_or_ensure_identical(card, "collectorNumberPrinted", collector_number_printed, card_id, report)
+        if elements is None:
+            elements = card["elements"] = {}
+        for property, value in current_card_lang["elements"].items():
+            kind = get_element_kind(property)
+            if kind == "localized":
+                if property not in elements:
+                    elements[property] = {}
+                elements[property][language] = value
+                continue
+            if kind == "optional":
+                value = value if value != "" else None
+            elif kind == "int":
+                value = int(value) if value != "" else None
+            add_property_or_ensure_identical(elements, property, value, card_id, report)
+    return card
+
+def add_property_or_ensure_identical(card, property_name, property_value, card_id=None, report=None):
     if property_name in card:
-        if card[property_name] != property_value:
-            print(f"Property {property_name} is different for card {card['id']}: {card[property_name]} != {property_value}")
+        if card[property_name] != property_value and report is not None:
+            report.add("different_property", card_id if card_id is not None else card.get("id"), property_name, values=[card[property_name], property_value])
     else:
         card[property_name] = property_value
 
+def get_stats_index(dump_temp_files, temp_folder, include_uniques, items_per_page, collection_token, max_workers, http_cache, checkpoints=None):
+    # Collection stats are not language specific, so only load them once, if there is a collection
+    if not collection_token:
+        return {}
+    print("Importing stats data")
+    with metrics.timer("fetch_stats"):
+        if max_workers > 1:
+            raw_stats_data = get_data_languages_concurrent("cards/stats", ["en"], include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, max_workers=max_workers, http_cache=http_cache, checkpoints=checkpoints)["en"]
+        else:
+            raw_stats_data = get_data_language("cards/stats", "en", include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, checkpoints=checkpoints)
+    if dump_temp_files:
+        dump_json(raw_stats_data, join(temp_folder, 'raw_stats_data.json'))
+    with metrics.timer("index_stats"):
+        return index_stats_data(raw_stats_data)
+
+def open_checkpoints(checkpoint_folder, resume, include_uniques, items_per_page, collection_token):
+    if not checkpoint_folder:
+        return None
+    run_key = {
+        "api": API_URL,
+        "includeUniques": include_uniques,
+        "itemsPerPage": items_per_page,
+        # The token may have been renewed since the interrupted run
+        "collection": bool(collection_token)
+    }
+    return FetchCheckpoints(checkpoint_folder, run_key, resume=resume)
+
 def get_cards_data(
     languages=LANGUAGES,
     dump_temp_files=DUMP_TEMP_FILES,
@@ -217,40 +530,55 @@ def get_cards_data(
     include_promo_cards=INCLUDE_PROMO_CARDS,
     include_foilers=INCLUDE_FOILERS,
     force_include_ks_uniques=FORCE_INCLUDE_KS_UNIQUES,
-    items_per_page=ITEMS_PER_PAGE,
-    collection_token=COLLECTION_TOKEN
+    items_per_page=PAGE_SIZE,
+    collection_token=COLLECTION_TOKEN,
+    max_workers=MAX_WORKERS,
+    http_cache_folder=HTTP_CACHE_FOLDER,
+    checkpoint_folder=CHECKPOINT_FOLDER,
+    resume=RESUME,
+    merge_report=None
 ):
     if dump_temp_files:
         create_folder_if_not_exists(temp_folder)
 
+    http_cache = None
+    if http_cache_folder:
+        http_cache = HttpCache(http_cache_folder, ttl=HTTP_CACHE_TTL, max_size=HTTP_CACHE_MAX_SIZE)
+
     treated_cards = {}
     treated_types = {}
     treated_subtypes = {}
     treated_factions = {}
     treated_rarities = {}
 
-    # Collection stats are not language specific, so only load them once, if there is a collection
-    raw_stats_data = []
-    if collection_token:
-        print("Importing stats data")
-        raw_stats_data = get_data_language("cards/stats", "en", include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
-        if dump_temp_files:
-            dump_json(raw_cards_data, join(temp_folder, 'raw_stats_data_' + language + '.json'))
+    checkpoints = open_checkpoints(checkpoint_folder, resume, include_uniques, items_per_page, collection_token)
+    stats_index = get_stats_index(dump_temp_files, temp_folder, include_uniques, items_per_page, collection_token, max_workers, http_cache, checkpoints=checkpoints)
+
+    prefetched_cards_data = {}
+    if max_workers > 1:
+        print(f"Importing card data for languages {', '.join(languages)} ({max_workers} parallel requests)")
+        with metrics.timer("fetch_cards"):
+            prefetched_cards_data = get_data_languages_concurrent("cards", languages, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, max_workers=max_workers, http_cache=http_cache, checkpoints=checkpoints)
 
     for language in languages:
-        print("Importing card data for language " + language)
-        raw_cards_data = get_data_language("cards", language, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
+        if language in prefetched_cards_data:
+            raw_cards_data = prefetched_cards_data.pop(language)
+        else:
+            print("Importing card data for language " + language)
+            with metrics.timer("fetch_cards"):
+                raw_cards_data = get_data_language("cards", language, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, checkpoints=checkpoints)
         if dump_temp_files:
             dump_json(raw_cards_data, join(temp_folder, 'raw_cards_data_' + language + '.json'))
-        tcards, ttypes, tsubtypes, tfactions, trarities = treat_cards_data(
-            raw_cards_data,
-            raw_stats_data,
-            include_uniques=include_uniques,
-            include_ks=include_ks,
-            include_promo_cards=include_promo_cards,
-            include_foilers=include_foilers,
-            force_include_ks_uniques=force_include_ks_uniques
-        )
+        with metrics.timer("treat"):
+            tcards, ttypes, tsubtypes, tfactions, trarities = treat_cards_data(
+                raw_cards_data,
+                stats_index,
+                include_uniques=include_uniques,
+                include_ks=include_ks,
+                include_promo_cards=include_promo_cards,
+                include_foilers=include_foilers,
+                force_include_ks_uniques=force_include_ks_uniques
+            )
         if DUMP_TEMP_FILES:
             dump_json(tcards   , join(temp_folder, 'cards_' + language + '.json'))
             dump_json(ttypes   , join(temp_folder, 'types_' + language + '.json'))
@@ -263,18 +591,217 @@ def get_cards_data(
         treated_factions[language] = tfactions
         treated_rarities[language] = trarities
 
-    cards    = merge_cards_data(treated_cards, skip_not_all_languages=skip_not_all_languages, is_collection=bool(collection_token))
+    # Everything is fetched, the next run starts from scratch
+    if checkpoints is not None:
+        checkpoints.clear()
+
+    with metrics.timer("merge"):
+        cards = merge_cards_data(treated_cards, skip_not_all_languages=skip_not_all_languages, is_collection=bool(collection_token), report=merge_report)
     types    = merge_language_dicts(treated_types)
     subtypes = merge_language_dicts(treated_subtypes)
     factions = merge_language_dicts(treated_factions)
     rarities = merge_language_dicts(treated_rarities)
     return cards, types, subtypes, factions, rarities
 
+def iter_checked_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=None, stale=None):
+    # Yields the cards of each page of the faction, then checks the number of distinct cards of
+    # the last version of each page against the total. On a mismatch, the faction is walked
+    # again, as in get_data_language_faction. The references yielded that are not part of the
+    # faction in the end (removed mid-walk, or only seen by a failed walk) are added to stale
+    yielded = set()
+    for attempt in range(2):
+        page_references = {}
+        for page, page_data, total in iter_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=checkpoints):
+            page_references[page] = [card["reference"] for card in page_data]
+            yielded.update(page_references[page])
+            yield page_data
+        references = set().union(*page_references.values())
+        if len(references) == total:
+            break
+        if attempt == 0:
+            print(f"The number of cards ({len(references)}) does not match the total ({total}), fetching the faction again")
+            if checkpoints is not None:
+                checkpoints.clear_faction(apiEndpoint, language, faction)
+    else:
+        raise Exception(f"Error: total ({total}) is different compared to number of cards ({len(references)})")
+    if stale is not None:
+        stale.update(yielded - references)
+
+def iter_pages_language(apiEndpoint, language, include_uniques=INCLUDE_UNIQUES, items_per_page=PAGE_SIZE, collection_token=None, http_cache=None, checkpoints=None, stale=None):
+    # Yields the pages of every faction one at a time. The cards yielded twice when the total
+    # changes mid-walk are removed when the sorted runs are read back, as well as the cards
+    # added to stale (see iter_checked_faction_pages)
+    for faction in FACTIONS:
+        print(f"==== {language} Faction {faction} ====")
+        yield from iter_checked_faction_pages(apiEndpoint, language, faction, include_uniques, items_per_page, collection_token, http_cache, checkpoints=checkpoints, stale=stale)
+
+def spill_sorted_runs(cards, folder, prefix, chunk_size=STREAM_CHUNK_SIZE):
+    # Writes the cards to NDJSON files of at most chunk_size cards, each sorted by id
+    runs = []
+    buffer = []
+    def flush():
+        buffer.sort(key=lambda card: card["id"])
+        path = join(folder, f"{prefix}_{len(runs)}.ndjson")
+        with open(path, 'w', encoding="utf8") as f:
+            for card in buffer:
+                f.write(json.dumps(card, ensure_ascii=False) + "\n")
+        runs.append(path)
+        buffer.clear()
+    for card in cards:
+        buffer.append(card)
+        if len(buffer) >= chunk_size:
+            flush()
+    if buffer:
+        flush()
+    return runs
+
+def iter_ndjson(path):
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            yield json.loads(line)
+
+def iter_sorted_cards(runs, exclude=frozenset()):
+    # External merge of the runs by card id. When a card was fetched several times, the last version
+    # is kept. The cards whose id is in exclude are skipped
+    previous = None
+    for card in heapq.merge(*[iter_ndjson(run) for run in runs], key=lambda card: card["id"]):
+        if card["id"] in exclude:
+            continue
+        if previous is not None and previous["id"] != card["id"]:
+            yield previous
+        previous = card
+    if previous is not None:
+        yield previous
+
+def iter_merged_cards(sorted_cards_by_language, skip_not_all_languages, is_collection, report=None):
+    # Keyed merge of the sorted streams of each language, yields (card_id, merged_card) sorted by id
+    languages = list(sorted_cards_by_language)
+    def tag(cards, language_index):
+        for card in cards:
+            yield card["id"], language_index, card
+    streams = [tag(sorted_cards_by_language[language], i) for i, language in enumerate(languages)]
+    for card_id, group in itertools.groupby(heapq.merge(*streams, key=lambda item: item[:2]), key=lambda item: item[0]):
+        versions = [None] * len(languages)
+        for _, language_index, card in group:
+            versions[language_index] = card
+        card = merge_card_versions(card_id, languages, versions, skip_not_all_languages, is_collection, report)
+        if card is not None:
+            yield card_id, card
+
+def stream_cards_data(
+    output_folder=OUTPUT_FOLDER,
+    languages=LANGUAGES,
+    dump_temp_files=DUMP_TEMP_FILES,
+    temp_folder=TEMP_FOLDER,
+    skip_not_all_languages=SKIP_NOT_ALL_LANGUAGES,
+    include_uniques=INCLUDE_UNIQUES,
+    include_ks=INCLUDE_KS,
+    include_promo_cards=INCLUDE_PROMO_CARDS,
+    include_foilers=INCLUDE_FOILERS,
+    force_include_ks_uniques=FORCE_INCLUDE_KS_UNIQUES,
+    items_per_page=PAGE_SIZE,
+    collection_token=COLLECTION_TOKEN,
+    max_workers=MAX_WORKERS,
+    http_cache_folder=HTTP_CACHE_FOLDER,
+    checkpoint_folder=CHECKPOINT_FOLDER,
+    resume=RESUME,
+    merge_report=None,
+    chunk_size=STREAM_CHUNK_SIZE,
+    write_ndjson=WRITE_NDJSON
+):
+    # Same results as get_cards_data, written to output_folder, but the cards flow through
+    # fetch -> treat -> sorted runs on disk -> merge -> output, so the memory usage does not
+    # depend on the size of the catalog. The cards are written sorted by id
+    create_folder_if_not_exists(temp_folder)
+    create_folder_if_not_exists(output_folder)
+
+    http_cache = None
+    if http_cache_folder:
+        http_cache = HttpCache(http_cache_folder, ttl=HTTP_CACHE_TTL, max_size=HTTP_CACHE_MAX_SIZE)
+
+    checkpoints = open_checkpoints(checkpoint_folder, resume, include_uniques, items_per_page, collection_token)
+    stats_index = get_stats_index(dump_temp_files, temp_folder, include_uniques, items_per_page, collection_token, max_workers, http_cache, checkpoints=checkpoints)
+
+    treated_types = {}
+    treated_subtypes = {}
+    treated_factions = {}
+    treated_rarities = {}
+    with tempfile.TemporaryDirectory(dir=temp_folder) as spill_folder:
+        runs = {}
+        stale = {} # language -> ids of the cards yielded by the walks that are not part of the catalog
+        for language in languages:
+            print("Importing card data for language " + language)
+            ttypes, tsubtypes, tfactions, trarities = {}, {}, {}, {}
+            stale[language] = set()
+            def treated_cards():
+                for page_data in iter_pages_language("cards", language, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token, http_cache=http_cache, checkpoints=checkpoints, stale=stale[language]):
+                    for card in page_data:
+                        cdata = treat_card(card, stats_index, include_uniques, include_ks, include_promo_cards, include_foilers, force_include_ks_uniques)
+                        if cdata is not None:
+                            add_card_references(card, ttypes, tsubtypes, tfactions, trarities)
+                            yield cdata
+            with metrics.timer("fetch_treat_spill"):
+                runs[language] = spill_sorted_runs(treated_cards(), spill_folder, language, chunk_size=chunk_size)
+            treated_types[language] = ttypes
+            treated_subtypes[language] = tsubtypes
+            treated_factions[language] = tfactions
+            treated_rarities[language] = trarities
+
+        if checkpoints is not None:
+            checkpoints.clear()
+
+        print("Merging card data")
+        nb_cards = 0
+        ndjson_file = open(join(output_folder, 'cards.ndjson'), 'w', encoding="utf8") if write_ndjson else None
+        try:
+            with metrics.timer("merge_dump"), JsonObjectWriter(join(output_folder, 'cards.json')) as writer:
+                sorted_cards = {language: iter_sorted_cards(runs[language], exclude=stale[language]) for language in languages}
+                for card_id, card in iter_merged_cards(sorted_cards, skip_not_all_languages=skip_not_all_languages, is_collection=bool(collection_token), report=merge_report):
+                    writer.write(card_id, card)
+                    if ndjson_file is not None:
+                        ndjson_file.write(json.dumps(card, ensure_ascii=False) + "\n")
+                    nb_cards += 1
+        finally:
+            if ndjson_file is not None:
+                ndjson_file.close()
+
+    dump_json(merge_language_dicts(treated_types),    join(output_folder, 'types.json'))
+    dump_json(merge_language_dicts(treated_subtypes), join(output_folder, 'subtypes.json'))
+    dump_json(merge_language_dicts(treated_factions), join(output_folder, 'factions.json'))
+    dump_json(merge_language_dicts(treated_rarities), join(output_folder, 'rarities.json'))
+    print(f"{nb_cards} cards written")
+    return nb_cards
+
+def dump_cards_data(cards, types, subtypes, factions, rarities, output_folder=OUTPUT_FOLDER, snapshots=WRITE_SNAPSHOTS):
+    create_folder_if_not_exists(output_folder)
+    with metrics.timer("dump"):
+        dump_json(cards,    join(output_folder, 'cards.json'),    snapshot=snapshots)
+        dump_json(types,    join(output_folder, 'types.json'),    snapshot=snapshots)
+        dump_json(subtypes, join(output_folder, 'subtypes.json'), snapshot=snapshots)
+        dump_json(factions, join(output_folder, 'factions.json'), snapshot=snapshots)
+        dump_json(rarities, join(output_folder, 'rarities.json'), snapshot=snapshots)
+
+def fetch_cards_data(resume=RESUME):
+    # Fetches the cards data and writes the results to OUTPUT_FOLDER. Returns the results,
+    # or None in streaming mode, where they are never entirely in memory.
+    # The conflicts between the languages are written to a report instead of the console
+    merge_report = MergeReport()
+    results = None
+    if STREAMING_MODE:
+        stream_cards_data(resume=resume, merge_report=merge_report)
+    else:
+        results = get_cards_data(resume=resume, merge_report=merge_report)
+        dump_cards_data(*results)
+    merge_report.write(join(OUTPUT_FOLDER, 'merge_report.json'))
+    print(f"{merge_report.summary()} (see {join(OUTPUT_FOLDER, 'merge_report.json')})")
+    if COLLECTION_TOKEN and RECORD_COLLECTION_HISTORY:
+        cards = results[0] if results is not None else load_results_json(join(OUTPUT_FOLDER, 'cards.json'))
+        run, nb_changed = CollectionHistory().record(cards)
+        print(f"Collection history: run {run}, {nb_changed} card(s) changed")
+    return results
+
+def main():
+    fetch_cards_data(resume=RESUME or "--resume" in sys.argv[1:])
+
 if __name__ == "__main__":
-    cards, types, subtypes, factions, rarities = get_cards_data()
-    create_folder_if_not_exists(OUTPUT_FOLDER)
-    dump_json(cards,    join(OUTPUT_FOLDER, 'cards.json'))
-    dump_json(types,    join(OUTPUT_FOLDER, 'types.json'))
-    dump_json(subtypes, join(OUTPUT_FOLDER, 'subtypes.json'))
-    dump_json(factions, join(OUTPUT_FOLDER, 'factions.json'))
-    dump_json(rarities, join(OUTPUT_FOLDER, 'rarities.json'))
+    metrics.run_instrumented("get_cards_data", main)
@@ -5,6 +5,8 @@
 NAME_LANGUAGES = ["en", "fr"]
 ABILITIES_LANGUAGES = ["en", "fr"]
 MAIN_LANGUAGE = "en"
+CSV_LANGUAGES = [MAIN_LANGUAGE] # one CSV file is written for each of these main languages, e.g. ["en", "fr", "es", "it", "de"]
+CSV_PROCESSES = 1 # number of processes writing the CSV files, 1 writes them all in a single pass
 GROUP_SUBTYPES = False
 INCLUDE_WEB_ASSETS = False
 
@@ -13,114 +15,75 @@ FACTIONS_DATA_PATH = "results/factions.json"
 TYPES_DATA_PATH = "results/types.json"
 SUBTYPES_DATA_PATH = "results/subtypes.json"
 RARITIES_DATA_PATH = "results/rarities.json"
-CSV_OUTPUT_PATH = "results/cards_" + MAIN_LANGUAGE + ".csv"
+CSV_OUTPUT_PATH = "results/cards_{language}.csv"
 
 # Imports
-import os
 import csv
 import itertools
-from utils import load_json
+from multiprocessing import Pool
+from utils import load_results_json, check_files_exist
+import metrics
+
+# Constants
+COLLECTION_PROPERTIES = ["foiled", "inMyTradelist", "inMyCollection", "inMyWantlist"]
 
 def main():
-    if not os.path.exists(CARDS_DATA_PATH):
-        print(f"File {CARDS_DATA_PATH} not found. Have you run get_cards_data.py?")
-        return
-    if not os.path.exists(FACTIONS_DATA_PATH):
-        print(f"File {FACTIONS_DATA_PATH} not found. Have you run get_cards_data.py?")
-        return
-    if not os.path.exists(TYPES_DATA_PATH):
-        print(f"File {TYPES_DATA_PATH} not found. Have you run get_cards_data.py?")
+    if not check_files_exist([CARDS_DATA_PATH, FACTIONS_DATA_PATH, TYPES_DATA_PATH, SUBTYPES_DATA_PATH, RARITIES_DATA_PATH]):
         return
-    if not os.path.exists(SUBTYPES_DATA_PATH):
-        print(f"File {SUBTYPES_DATA_PATH} not found. Have you run get_cards_data.py?")
-        return
-    if not os.path.exists(RARITIES_DATA_PATH):
-        print(f"File {RARITIES_DATA_PATH} not found. Have you run get_cards_data.py?")
-        return
-    
-    data = load_json(CARDS_DATA_PATH)
-    factions = load_json(FACTIONS_DATA_PATH)
-    types = load_json(TYPES_DATA_PATH)
-    subtypes = load_json(SUBTYPES_DATA_PATH)
-    rarities = load_json(RARITIES_DATA_PATH)
-
-    cards_dicts = []
+
+    with metrics.timer("load"):
+        data = load_results_json(CARDS_DATA_PATH)
+        factions = load_results_json(FACTIONS_DATA_PATH)
+        types = load_results_json(TYPES_DATA_PATH)
+        subtypes = load_results_json(SUBTYPES_DATA_PATH)
+        rarities = load_results_json(RARITIES_DATA_PATH)
+
+    with metrics.timer("csv"):
+        write_csv_files(data, types, subtypes, factions, rarities, CSV_LANGUAGES, processes=CSV_PROCESSES)
+
+def write_csv_files(data, types, subtypes, factions, rarities, languages, processes=1):
+    # The subtype columns, field names and card order are computed once and shared by all languages
+    if len(languages) > 1 and "{language}" not in CSV_OUTPUT_PATH:
+        raise ValueError(f"CSV_OUTPUT_PATH ({CSV_OUTPUT_PATH}) must contain {{language}} to write the CSV files of several languages ({', '.join(languages)})")
     subtypes_cols = {}
     if not GROUP_SUBTYPES:
         subtypes_cols = get_subtypes_cols(data)
+    fieldnames = get_fieldnames(data, subtypes_cols)
+    sorted_cards = sorted(data.values(), key=lambda card: collector_number_sort_key(card["collectorNumberFormatted"][languages[0]]))
 
-    fieldnames = ["collectorNumber"]
+    if processes <= 1 or len(languages) <= 1:
+        write_csv_languages(sorted_cards, types, subtypes, factions, rarities, subtypes_cols, fieldnames, languages)
+        return
+    groups = [languages[i::processes] for i in range(min(processes, len(languages)))]
+    with Pool(len(groups)) as pool:
+        pool.starmap(write_csv_languages, [(sorted_cards, types, subtypes, factions, rarities, subtypes_cols, fieldnames, group) for group in groups])
+
+def write_csv_languages(sorted_cards, types, subtypes, factions, rarities, subtypes_cols, fieldnames, languages):
+    # Single pass over the cards, each row being written to the file of every language
+    files = {}
+    try:
+        writers = {}
+        for language in languages:
+            files[language] = open(CSV_OUTPUT_PATH.format(language=language), 'w', newline='', encoding="utf8")
+            writers[language] = csv.DictWriter(files[language], fieldnames=fieldnames)
+            writers[language].writeheader()
+        for card in sorted_cards:
+            card_dict = get_common_card_dict(card)
+            for language in languages:
+                writers[language].writerow({**card_dict, **get_localized_card_dict(card, language, types, subtypes, factions, rarities, subtypes_cols)})
+    finally:
+        for f in files.values():
+            f.close()
+    for language in languages:
+        print(f"{len(sorted_cards)} cards written to {CSV_OUTPUT_PATH.format(language=language)}")
 
+def get_fieldnames(data, subtypes_cols):
+    fieldnames = ["collectorNumber"]
+    # Include the collection stats if present in the cards data
     for card in data.values():
-        card_id = card["id"]
-        card_dict = {
-            "collectorNumber": card["collectorNumberFormatted"][MAIN_LANGUAGE],
-            "id": card_id,
-            "type": types[card["type"]][MAIN_LANGUAGE],
-            "faction": factions[card["mainFaction"]][MAIN_LANGUAGE],
-            "rarity": rarities[card["rarity"]][MAIN_LANGUAGE],
-            "imagePath": card["imagePath"][MAIN_LANGUAGE],
-        }
-        if GROUP_SUBTYPES:
-            card_dict["subtypes"] = ", ".join(sorted([subtypes[subtype][MAIN_LANGUAGE] for subtype in card["subtypes"]]))
-        else:
-            for subtype in card["subtypes"]:
-                card_dict["subtype_" + str(subtypes_cols[subtype]+1)] = subtypes[subtype][MAIN_LANGUAGE]
-
-        # Include the collection stats if present in the cards data
-        if "foiled" in card:
-            card_dict["foiled"] = card["foiled"]
-            if "foiled" not in fieldnames:
-                fieldnames.append("foiled")
-        if "inMyTradelist" in card:
-            card_dict["inMyTradelist"] = card["inMyTradelist"]
-            if "inMyTradelist" not in fieldnames:
-                fieldnames.append("inMyTradelist")
-        if "inMyCollection" in card:
-            card_dict["inMyCollection"] = card["inMyCollection"]
-            if "inMyCollection" not in fieldnames:
-                fieldnames.append("inMyCollection")
-        if "inMyWantlist" in card:
-            card_dict["inMyWantlist"] = card["inMyWantlist"]
-            if "inMyWantlist" not in fieldnames:
-                fieldnames.append("inMyWantlist")
-
-        if "elements" in card:
-            if "MAIN_COST" in card["elements"]:
-                card_dict["handCost"] = card["elements"]["MAIN_COST"]
-            if "RECALL_COST" in card["elements"]:
-                card_dict["reserveCost"] = card["elements"]["RECALL_COST"]
-            if "FOREST_POWER" in card["elements"]:
-                card_dict["forestPower"] = card["elements"]["FOREST_POWER"]
-            if "MOUNTAIN_POWER" in card["elements"]:
-                card_dict["mountainPower"] = card["elements"]["MOUNTAIN_POWER"]
-            if "OCEAN_POWER" in card["elements"]:
-                card_dict["waterPower"] = card["elements"]["OCEAN_POWER"]
-            if "PERMANENT" in card["elements"]:
-                card_dict["landmarksSize"] = card["elements"]["PERMANENT"]
-            if "RESERVE" in card["elements"]:
-                card_dict["reserveSize"] = card["elements"]["RESERVE"]
-            if "MAIN_EFFECT" in card["elements"]:
-                for language in ABILITIES_LANGUAGES:
-                    card_dict["abilities" + "_" + language] = card["elements"]["MAIN_EFFECT"][language]
-            if "ECHO_EFFECT" in card["elements"]:
-                for language in ABILITIES_LANGUAGES:
-                    card_dict["supportAbility" + "_" + language] = card["elements"]["ECHO_EFFECT"][language]
-        for language in NAME_LANGUAGES:
-            card_dict["name" + "_" + language] = card["name"][language]
-        if INCLUDE_WEB_ASSETS:
-            card_dict["webAsset0"] = None
-            card_dict["webAsset1"] = None
-            card_dict["webAsset2"] = None
-            if "WEB" in card["assets"]:
-                if len(card["assets"]["WEB"]) > 0:
-                    card_dict["webAsset0"] = card["assets"]["WEB"][0]
-                if len(card["assets"]["WEB"]) > 1:
-                    card_dict["webAsset1"] = card["assets"]["WEB"][1]
-                if len(card["assets"]["WEB"]) > 2:
-                    card_dict["webAsset2"] = card["assets"]["WEB"][2]
-        cards_dicts.append(card_dict)
-    
+        for property in COLLECTION_PROPERTIES:
+            if property in card and property not in fieldnames:
+                fieldnames.append(property)
     for language in NAME_LANGUAGES:
         fieldnames.append("name_" + language)
     fieldnames += ["faction", "rarity", "type"]
@@ -138,38 +101,103 @@ def main():
     fieldnames += ["id", "imagePath"]
     if INCLUDE_WEB_ASSETS:
         fieldnames += ["webAsset0", "webAsset1", "webAsset2"]
-    
-    with open(CSV_OUTPUT_PATH, 'w', newline='', encoding="utf8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for card_dict in sorted(cards_dicts, key=custom_sort):
-            writer.writerow(card_dict)
+    return fieldnames
+
+def get_common_card_dict(card):
+    # Columns that do not depend on the main language
+    card_dict = {
+        "id": card["id"]
+    }
+    for property in COLLECTION_PROPERTIES:
+        if property in card:
+            card_dict[property] = card[property]
+
+    if "elements" in card:
+        if "MAIN_COST" in card["elements"]:
+            card_dict["handCost"] = card["elements"]["MAIN_COST"]
+        if "RECALL_COST" in card["elements"]:
+            card_dict["reserveCost"] = card["elements"]["RECALL_COST"]
+        if "FOREST_POWER" in card["elements"]:
+            card_dict["forestPower"] = card["elements"]["FOREST_POWER"]
+        if "MOUNTAIN_POWER" in card["elements"]:
+            card_dict["mountainPower"] = card["elements"]["MOUNTAIN_POWER"]
+        if "OCEAN_POWER" in card["elements"]:
+            card_dict["waterPower"] = card["elements"]["OCEAN_POWER"]
+        if "PERMANENT" in card["elements"]:
+            card_dict["landmarksSize"] = card["elements"]["PERMANENT"]
+        if "RESERVE" in card["elements"]:
+            card_dict["reserveSize"] = card["elements"]["RESERVE"]
+        if "MAIN_EFFECT" in card["elements"]:
+            for language in ABILITIES_LANGUAGES:
+                card_dict["abilities" + "_" + language] = card["elements"]["MAIN_EFFECT"][language]
+        if "ECHO_EFFECT" in card["elements"]:
+            for language in ABILITIES_LANGUAGES:
+                card_dict["supportAbility" + "_" + language] = card["elements"]["ECHO_EFFECT"][language]
+    for language in NAME_LANGUAGES:
+        card_dict["name" + "_" + language] = card["name"][language]
+    if INCLUDE_WEB_ASSETS:
+        card_dict["webAsset0"] = None
+        card_dict["webAsset1"] = None
+        card_dict["webAsset2"] = None
+        if "WEB" in card["assets"]:
+            if len(card["assets"]["WEB"]) > 0:
+                card_dict["webAsset0"] = card["assets"]["WEB"][0]
+            if len(card["assets"]["WEB"]) > 1:
+                card_dict["webAsset1"] = card["assets"]["WEB"][1]
+            if len(card["assets"]["WEB"]) > 2:
+                card_dict["webAsset2"] = card["assets"]["WEB"][2]
+    return card_dict
+
+def get_localized_card_dict(card, language, types, subtypes, factions, rarities, subtypes_cols):
+    card_dict = {
+        "collectorNumber": card["collectorNumberFormatted"][language],
+        "type": types[card["type"]][language],
+        "faction": factions[card["mainFaction"]][language],
+        "rarity": rarities[card["rarity"]][language],
+        "imagePath": card["imagePath"][language],
+    }
+    if GROUP_SUBTYPES:
+        card_dict["subtypes"] = ", ".join(sorted([subtypes[subtype][language] for subtype in card["subtypes"]]))
+    else:
+        for subtype in card["subtypes"]:
+            card_dict["subtype_" + str(subtypes_cols[subtype]+1)] = subtypes[subtype][language]
+    return card_dict
 
 def custom_sort(card):
-    beforeRarity = card["collectorNumber"][:-4]
-    afterRarity = card["collectorNumber"][-3:]
-    rarity = card["collectorNumber"][-4]
+    return collector_number_sort_key(card["collectorNumber"])
+
+def collector_number_sort_key(collector_number):
+    beforeRarity = collector_number[:-4]
+    afterRarity = collector_number[-3:]
+    rarity = collector_number[-4]
     fixedRarity = rarity if rarity != "R" else "D"
     return beforeRarity + fixedRarity + afterRarity
 
 def get_subtypes_cols(data):
+    # Greedy colouring of the graph of subtypes appearing together on a card, so that
+    # the subtypes of a card are always in different columns. The most frequent
+    # subtypes are placed first, ties are broken by order of appearance
     subtypes_counts = {}
-    subtypes_incompatibilities = set()
+    subtypes_neighbours = {}
     for card in data.values():
         for subtype in card["subtypes"]:
             if subtype not in subtypes_counts:
                 subtypes_counts[subtype] = 0
+                subtypes_neighbours[subtype] = set()
             subtypes_counts[subtype] += 1
-        for comb in itertools.combinations(card["subtypes"], 2):
-            subtypes_incompatibilities.add(comb)
+        for subtype, other in itertools.combinations(card["subtypes"], 2):
+            if subtype != other:
+                subtypes_neighbours[subtype].add(other)
+                subtypes_neighbours[other].add(subtype)
     ordered_subtypes = sorted(subtypes_counts, key=lambda x: subtypes_counts[x], reverse=True)
     subtypes_cols = {}
     for subtype in ordered_subtypes:
+        used_cols = {subtypes_cols[other] for other in subtypes_neighbours[subtype] if other in subtypes_cols}
         col = 0
-        while col in [subtypes_cols[other] for other in subtypes_cols if tuple(sorted((subtype, other))) in subtypes_incompatibilities]:
+        while col in used_cols:
             col += 1
         subtypes_cols[subtype] = col
     return subtypes_cols
 
 if __name__ == "__main__":
-    main()
+    metrics.run_instrumented("get_csv_data", main)
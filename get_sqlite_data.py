@@ -0,0 +1,153 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+CARDS_DATA_PATH = "results/cards.json"
+FACTIONS_DATA_PATH = "results/factions.json"
+TYPES_DATA_PATH = "results/types.json"
+SUBTYPES_DATA_PATH = "results/subtypes.json"
+RARITIES_DATA_PATH = "results/rarities.json"
+SQLITE_OUTPUT_PATH = "results/cards.sqlite"
+
+# Imports
+import os
+import sqlite3
+from utils import load_results_json, check_files_exist
+import metrics
+
+# Constants
+ELEMENT_COLUMNS = {
+    "MAIN_COST": "main_cost",
+    "RECALL_COST": "recall_cost",
+    "FOREST_POWER": "forest_power",
+    "MOUNTAIN_POWER": "mountain_power",
+    "OCEAN_POWER": "ocean_power",
+    "PERMANENT": "permanent",
+    "RESERVE": "reserve"
+}
+COLLECTION_COLUMNS = {
+    "inMyCollection": "in_my_collection",
+    "inMyWantlist": "in_my_wantlist",
+    "inMyTradelist": "in_my_tradelist",
+    "foiled": "foiled"
+}
+SCHEMA = f"""
+CREATE TABLE types (reference TEXT NOT NULL, language TEXT NOT NULL, name TEXT, PRIMARY KEY (reference, language));
+CREATE TABLE subtypes (reference TEXT NOT NULL, language TEXT NOT NULL, name TEXT, PRIMARY KEY (reference, language));
+CREATE TABLE factions (reference TEXT NOT NULL, language TEXT NOT NULL, name TEXT, PRIMARY KEY (reference, language));
+CREATE TABLE rarities (reference TEXT NOT NULL, language TEXT NOT NULL, name TEXT, PRIMARY KEY (reference, language));
+CREATE TABLE cards (
+    id TEXT PRIMARY KEY,
+    type TEXT,
+    main_faction TEXT,
+    rarity TEXT,
+    collector_number_printed TEXT,
+    {", ".join(column + " INTEGER" for column in ELEMENT_COLUMNS.values())},
+    {", ".join(column + " INTEGER" for column in COLLECTION_COLUMNS.values())}
+);
+CREATE TABLE card_localizations (
+    card_id TEXT NOT NULL REFERENCES cards(id),
+    language TEXT NOT NULL,
+    name TEXT,
+    image_path TEXT,
+    collector_number_formatted TEXT,
+    PRIMARY KEY (card_id, language)
+);
+CREATE TABLE card_subtypes (card_id TEXT NOT NULL REFERENCES cards(id), subtype TEXT NOT NULL, position INTEGER NOT NULL, PRIMARY KEY (card_id, position));
+CREATE TABLE card_assets (card_id TEXT NOT NULL REFERENCES cards(id), asset_type TEXT NOT NULL, position INTEGER NOT NULL, url TEXT, PRIMARY KEY (card_id, asset_type, position));
+CREATE TABLE card_elements (card_id TEXT NOT NULL REFERENCES cards(id), element TEXT NOT NULL, value, PRIMARY KEY (card_id, element));
+CREATE TABLE card_effects (card_id TEXT NOT NULL REFERENCES cards(id), language TEXT NOT NULL, element TEXT NOT NULL, text TEXT, PRIMARY KEY (card_id, language, element));
+CREATE INDEX cards_main_faction ON cards (main_faction);
+CREATE INDEX cards_rarity ON cards (rarity);
+CREATE INDEX cards_type ON cards (type);
+CREATE INDEX cards_main_cost ON cards (main_cost);
+CREATE INDEX cards_recall_cost ON cards (recall_cost);
+CREATE INDEX cards_collector_number_printed ON cards (collector_number_printed);
+CREATE INDEX card_localizations_collector_number_formatted ON card_localizations (collector_number_formatted);
+CREATE INDEX card_subtypes_subtype ON card_subtypes (subtype);
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE card_effects_fts USING fts5(main_effect, echo_effect, card_id UNINDEXED, language UNINDEXED);
+"""
+
+def main():
+    if not check_files_exist([CARDS_DATA_PATH, FACTIONS_DATA_PATH, TYPES_DATA_PATH, SUBTYPES_DATA_PATH, RARITIES_DATA_PATH]):
+        return
+
+    with metrics.timer("load"):
+        data = load_results_json(CARDS_DATA_PATH)
+        factions = load_results_json(FACTIONS_DATA_PATH)
+        types = load_results_json(TYPES_DATA_PATH)
+        subtypes = load_results_json(SUBTYPES_DATA_PATH)
+        rarities = load_results_json(RARITIES_DATA_PATH)
+
+    with metrics.timer("sqlite"):
+        write_sqlite(SQLITE_OUTPUT_PATH, data, types, subtypes, factions, rarities)
+
+def write_sqlite(path, data, types, subtypes, factions, rarities):
+    # The database is written next to its final path, and only replaces it once complete
+    tmp_path = path + ".part"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        has_fts = True
+        try:
+            connection.executescript(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            print("Warning: this SQLite build has no FTS5 support, the effects will not be searchable")
+            has_fts = False
+
+        for table, names in [("types", types), ("subtypes", subtypes), ("factions", factions), ("rarities", rarities)]:
+            connection.executemany(
+                f"INSERT INTO {table} (reference, language, name) VALUES (?, ?, ?)",
+                [(reference, language, name) for reference in names for language, name in names[reference].items()]
+            )
+
+        card_columns = ["id", "type", "main_faction", "rarity", "collector_number_printed"] + list(ELEMENT_COLUMNS.values()) + list(COLLECTION_COLUMNS.values())
+        insert_card = f"INSERT INTO cards ({', '.join(card_columns)}) VALUES ({', '.join('?' * len(card_columns))})"
+        for card in data.values():
+            card_id = card["id"]
+            elements = card.get("elements", {})
+            connection.execute(insert_card, [
+                card_id,
+                card["type"],
+                card["mainFaction"],
+                card["rarity"],
+                card.get("collectorNumberPrinted")
+            ] + [elements.get(element) for element in ELEMENT_COLUMNS] + [card.get(property) for property in COLLECTION_COLUMNS])
+            connection.executemany(
+                "INSERT INTO card_localizations (card_id, language, name, image_path, collector_number_formatted) VALUES (?, ?, ?, ?, ?)",
+                [(card_id, language, card["name"][language], card["imagePath"].get(language), card["collectorNumberFormatted"].get(language)) for language in card["name"]]
+            )
+            connection.executemany(
+                "INSERT INTO card_subtypes (card_id, subtype, position) VALUES (?, ?, ?)",
+                [(card_id, subtype, position) for position, subtype in enumerate(card["subtypes"])]
+            )
+            if isinstance(card["assets"], dict):
+                connection.executemany(
+                    "INSERT INTO card_assets (card_id, asset_type, position, url) VALUES (?, ?, ?, ?)",
+                    [(card_id, asset_type, position, url) for asset_type in card["assets"] for position, url in enumerate(card["assets"][asset_type])]
+                )
+            effects = {}
+            for element, value in elements.items():
+                if isinstance(value, dict):
+                    for language, text in value.items():
+                        connection.execute("INSERT INTO card_effects (card_id, language, element, text) VALUES (?, ?, ?, ?)", (card_id, language, element, text))
+                        effects.setdefault(language, {})[element] = text
+                else:
+                    connection.execute("INSERT INTO card_elements (card_id, element, value) VALUES (?, ?, ?)", (card_id, element, value))
+            if has_fts:
+                connection.executemany(
+                    "INSERT INTO card_effects_fts (main_effect, echo_effect, card_id, language) VALUES (?, ?, ?, ?)",
+                    [(texts.get("MAIN_EFFECT"), texts.get("ECHO_EFFECT"), card_id, language) for language, texts in effects.items()]
+                )
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    print(f"{len(data)} cards written to {path}")
+
+if __name__ == "__main__":
+    metrics.run_instrumented("get_sqlite_data", main)
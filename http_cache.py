@@ -0,0 +1,102 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Imports
+import os
+import json
+import time
+import hashlib
+import threading
+from utils import create_folder_if_not_exists
+
+class HttpCache:
+    # On-disk cache of JSON responses, with conditional revalidation data, a TTL
+    # and a least recently used eviction once the folder exceeds max_size bytes
+    def __init__(self, folder, ttl=3600, max_size=512 * 1024 * 1024):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        create_folder_if_not_exists(folder)
+        self.sizes = {}
+        for file_name in os.listdir(folder):
+            if file_name.endswith(".json"):
+                self.sizes[file_name] = os.path.getsize(os.path.join(folder, file_name))
+        self.total_size = sum(self.sizes.values())
+
+    def key_file_name(self, key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest() + ".json"
+
+    def get(self, key):
+        file_name = self.key_file_name(key)
+        path = os.path.join(self.folder, file_name)
+        try:
+            with open(path, encoding="utf8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        try:
+            os.utime(path) # The modification time is the last access time for the eviction
+        except OSError:
+            pass # Evicted by another thread since it was read, the entry is still valid
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, key, body, etag=None, last_modified=None):
+        entry = {
+            "key": key,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+            "body": body
+        }
+        self.write(key, entry)
+        return entry
+
+    def refresh(self, key, entry):
+        # Called after a 304 response: the stored body is valid for another TTL
+        entry["fetched_at"] = time.time()
+        self.write(key, entry)
+
+    def write(self, key, entry):
+        file_name = self.key_file_name(key)
+        path = os.path.join(self.folder, file_name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding="utf8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_size += os.path.getsize(path) - self.sizes.get(file_name, 0)
+            self.sizes[file_name] = os.path.getsize(path)
+            if self.total_size > self.max_size:
+                self.evict(keep=file_name)
+
+    def evict(self, keep=None):
+        entries = []
+        for file_name in self.sizes:
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.folder, file_name)), file_name))
+            except OSError:
+                entries.append((0, file_name))
+        for _, file_name in sorted(entries):
+            if self.total_size <= self.max_size:
+                break
+            if file_name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.folder, file_name))
+            except OSError:
+                pass
+            self.total_size -= self.sizes.pop(file_name)
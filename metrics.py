@@ -0,0 +1,131 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+METRICS_FOLDER = "metrics" # a metrics JSON file is written there at the end of each run, None disables it
+PROFILE = False # also profile the run with cProfile, the stats are written next to the metrics
+
+# Imports
+import os
+import json
+import time
+import cProfile
+import threading
+import contextlib
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# Run-wide metrics, shared by all the scripts of a process
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_requests = []
+_started_at = time.time()
+
+def reset():
+    global _started_at
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _requests.clear()
+        _started_at = time.time()
+
+@contextlib.contextmanager
+def timer(name):
+    # Accumulates the time spent in the block under name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+def add_time(name, seconds):
+    with _lock:
+        entry = _timers.setdefault(name, {"count": 0, "seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] += seconds
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def url_class(url):
+    parts = urlsplit(url)
+    if parts.path.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+        return f"{parts.netloc} (images)"
+    return parts.netloc + parts.path
+
+def record_request(url, status, latency, nb_bytes, attempts):
+    with _lock:
+        _requests.append({
+            "url": url,
+            "class": url_class(url),
+            "status": status,
+            "latency": latency,
+            "bytes": nb_bytes,
+            "attempts": attempts
+        })
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    return sorted(values)[min(len(values) - 1, int(ratio * len(values)))]
+
+def summary():
+    with _lock:
+        requests_by_class = {}
+        for record in _requests:
+            requests_by_class.setdefault(record["class"], []).append(record)
+        classes = {}
+        for name, records in requests_by_class.items():
+            latencies = [record["latency"] for record in records]
+            statuses = {}
+            for record in records:
+                statuses[str(record["status"])] = statuses.get(str(record["status"]), 0) + 1
+            classes[name] = {
+                "count": len(records),
+                "statuses": statuses,
+                "attempts": sum(record["attempts"] for record in records),
+                "bytes": sum(record["bytes"] or 0 for record in records),
+                "latency_total": sum(latencies),
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+                "latency_max": max(latencies)
+            }
+        return {
+            "started_at": datetime.fromtimestamp(_started_at).isoformat(),
+            "duration": time.time() - _started_at,
+            "timers": {name: dict(entry) for name, entry in _timers.items()},
+            "counters": dict(_counters),
+            "request_classes": classes,
+            "requests": list(_requests)
+        }
+
+def write_metrics(path):
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path, 'w', encoding="utf8") as f:
+        json.dump(summary(), f, indent=2, ensure_ascii=False)
+
+def run_instrumented(name, main):
+    # Runs main(), then writes the metrics of the run to METRICS_FOLDER/<name>_<date>.json
+    # (and the cProfile stats to a .prof file with the same name if PROFILE)
+    reset()
+    base_path = None
+    if METRICS_FOLDER:
+        base_path = os.path.join(METRICS_FOLDER, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    profiler = cProfile.Profile() if PROFILE else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with timer("total"):
+            return main()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if base_path is not None:
+            write_metrics(base_path + ".json")
+            if profiler is not None:
+                profiler.dump_stats(base_path + ".prof")
+            print(f"Metrics written to {base_path}.json")
@@ -0,0 +1,201 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+HOST = "127.0.0.1"
+PORT = 8000
+NB_CARDS = 10000
+LATENCY = 0 # seconds added to every response
+ERROR_RATE = 0 # probability of answering with a 500 error
+THROTTLE_RATE = 0 # probability of answering with a 429 error
+RETRY_AFTER = 1 # seconds, sent with the 429 errors
+MAX_ITEMS_PER_PAGE = 1000 # larger page sizes are capped, as the real API does
+IMAGE_SIZE = 50 * 1024 # bytes
+
+# Imports
+import json
+import base64
+import struct
+import time
+import random
+import hashlib
+import threading
+from array import array
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from get_cards_data import FACTIONS
+
+# Constants
+RARITIES = ["COMMON", "RARE", "UNIQUE"]
+LAST_MODIFIED = formatdate(0, usegmt=True)
+MOCK_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABQODxIPDRQSEBIXFRQYHjIhHhwcHj0sLiQySUBMS0dA"
+    "RkVQWnNiUFVtVkVGZIhlbXd7gYKBTmCNl4x9lnN+gXz/2wBDARUXFx4aHjshITt8U0ZTfHx8fHx8"
+    "fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHx8fHz/wAARCABYAD8DASIA"
+    "AhEBAxEB/8QAGAABAQEBAQAAAAAAAAAAAAAAAAMCBQb/xAAWEAEBAQAAAAAAAAAAAAAAAAABAAL/"
+    "xAAYAQEBAQEBAAAAAAAAAAAAAAAEAwYBBf/EABYRAQEBAAAAAAAAAAAAAAAAAAEAAv/aAAwDAQAC"
+    "EQMRAD8A8rkqZJkqZL1VuYZkt5JkqZKSzcMyVMkyVMlNZmGZKgTJbCmszDcjJUyTJUySVsrhmSpk"
+    "mSpkpLMwzJUyTJbyU1m4ZkqBMlQKazMNyMlTJMlTJIWyuGZLeSZKmSmszDMlTJMlTJTWbhmSoEyW"
+    "wprMw3IyVMkyVMkhbK4ZkqZJkqZKazMMyVMkyW8lNZmGZKgTJUCms3DcjJUyTJUySFsrhmS3kmSp"
+    "kprMwzJUyTJUyU1mYZkqBMlsKazMNyclvJJJbL4qZKmSSmzMVMlTJJTZmLeSoElNmYv/2Q=="
+) # 63x88 image served with padding comments, so that the images can be decoded
+
+def make_raw_card(i, language="en", base_url="https://example.com"):
+    # Card number i of a synthetic catalog, in the format of the API
+    faction = FACTIONS[i % len(FACTIONS)]
+    rarity = RARITIES[i % 3]
+    reference = f"ALT_CORE_B_{faction}_{i % 100:02d}_{rarity[0]}_{i}"
+    elements = {
+        "MAIN_COST": str(i % 7),
+        "RECALL_COST": str(i % 5),
+        "FOREST_POWER": str(i % 4),
+        "MOUNTAIN_POWER": str(i % 3),
+        "OCEAN_POWER": str(i % 2),
+        "MAIN_EFFECT": f"Effect of card {i} ({language})"
+    }
+    if i % 4 == 0:
+        elements["ECHO_EFFECT"] = f"Support effect of card {i} ({language})"
+    return {
+        "reference": reference,
+        "name": f"Card {i} ({language})",
+        "cardType": {"reference": "CHARACTER", "name": f"Character ({language})"},
+        "cardSubTypes": [{"reference": f"SUBTYPE_{i % 40}", "name": f"Subtype {i % 40} ({language})"}],
+        "imagePath": f"{base_url}/images/{language}/{reference}.jpg",
+        "assets": {"WEB": [f"{base_url}/images/assets/{reference}_WEB.jpg"]},
+        "mainFaction": {"reference": faction, "name": f"Faction {faction} ({language})"},
+        "elements": elements,
+        "rarity": {"reference": rarity, "name": f"{rarity} ({language})"},
+        "collectorNumberFormatted": f"BTG-{i % 1000:03d}-{rarity[0]}"
+    }
+
+def make_raw_stats(i):
+    return {
+        "reference": make_raw_card(i)["reference"],
+        "inMyCollection": i % 4,
+        "inMyWantlist": i % 5 == 0,
+        "inMyTradelist": i % 2,
+        "foiled": i % 3
+    }
+
+class MockApiServer:
+    # Local stand-in for api.altered.gg serving a synthetic catalog of nb_cards cards (in
+    # every language) with the Hydra pagination format, and the card images
+    def __init__(self, nb_cards=NB_CARDS, host=HOST, port=PORT, latency=LATENCY, error_rate=ERROR_RATE, throttle_rate=THROTTLE_RATE, seed=0):
+        self.nb_cards = nb_cards
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.bytes_sent = 0
+        self.indexes = {} # (faction, rarities) -> card numbers matching the filters
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                server.handle(self)
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def card_numbers(self, faction, rarities):
+        key = (faction, tuple(sorted(rarities)))
+        with self.lock:
+            if key not in self.indexes:
+                rarity_codes = {RARITIES.index(rarity) for rarity in rarities if rarity in RARITIES}
+                self.indexes[key] = array('l', (i for i in range(self.nb_cards) if i % 3 in rarity_codes and (faction is None or FACTIONS[i % len(FACTIONS)] == faction)))
+            return self.indexes[key]
+
+    def send(self, handler, status, body=b"", headers=None):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+
+    def handle(self, handler):
+        with self.lock:
+            self.nb_requests += 1
+            roll = self.random.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if roll < self.throttle_rate:
+            return self.send(handler, 429, headers={"Retry-After": str(RETRY_AFTER)})
+        if roll < self.throttle_rate + self.error_rate:
+            return self.send(handler, 500)
+
+        url = urlsplit(handler.path)
+        query = parse_qs(url.query)
+        if url.path.startswith("/images/"):
+            body = self.image(url.path)
+        elif url.path in ["/cards", "/cards/stats"]:
+            if "collection" in query and "Authorization" not in handler.headers:
+                return self.send(handler, 401)
+            language = handler.headers.get("Accept-Language", "en-en")[:2]
+            body = self.page(url.path, language, query)
+        else:
+            return self.send(handler, 404)
+
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if handler.headers.get("If-None-Match") == etag:
+            return self.send(handler, 304, headers={"ETag": etag})
+        content_type = "image/jpeg" if url.path.startswith("/images/") else "application/ld+json"
+        self.send(handler, 200, body, headers={"Content-Type": content_type, "ETag": etag, "Last-Modified": LAST_MODIFIED})
+
+    def page(self, path, language, query):
+        items_per_page = min(int(query.get("itemsPerPage", ["30"])[0]), MAX_ITEMS_PER_PAGE)
+        page = int(query.get("page", ["1"])[0])
+        faction = query.get("factions[]", [None])[0]
+        numbers = self.card_numbers(faction, query.get("rarity[]", RARITIES))
+        selected = numbers[(page - 1) * items_per_page:page * items_per_page]
+        if path == "/cards/stats":
+            members = [make_raw_stats(i) for i in selected]
+        else:
+            members = [make_raw_card(i, language, self.url) for i in selected]
+        return json.dumps({"hydra:member": members, "hydra:totalItems": len(numbers)}).encode("utf8")
+
+    def image(self, path):
+        # A real JPEG, unique to the path and about IMAGE_SIZE bytes long: the padding is
+        # written in comment segments (of at most 65533 bytes each) after the JFIF header
+        seed = hashlib.sha256(path.encode("utf8")).digest()
+        padding = (seed * (IMAGE_SIZE // len(seed) + 1))[:max(len(seed), IMAGE_SIZE - len(MOCK_JPEG))]
+        comments = b"".join(b"\xff\xfe" + struct.pack(">H", len(padding[i:i + 65533]) + 2) + padding[i:i + 65533] for i in range(0, len(padding), 65533))
+        header_end = 4 + struct.unpack(">H", MOCK_JPEG[4:6])[0] # SOI marker, then the APP0 segment
+        return MOCK_JPEG[:header_end] + comments + MOCK_JPEG[header_end:]
+
+def main():
+    server = MockApiServer()
+    print(f"Serving {server.nb_cards} cards on {server.url} (set API_URL in get_cards_data.py to use it)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
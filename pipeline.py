@@ -0,0 +1,182 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+PIPELINE_STAGES = ["fetch", "csv", "images"] # in order, among the keys of STAGES (e.g. add "sqlite", or "variants" after "images")
+PIPELINE_STATE_PATH = "results/pipeline_state.json" # input fingerprints of the last run of each stage
+FETCH_MAX_AGE = 24 * 3600 # seconds after which the cards data is fetched again, 0 always fetches it
+
+# Imports
+import sys
+import json
+import time
+import hashlib
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+from utils import dump_json, load_json, load_results_json, check_files_exist, file_sha256
+import metrics
+import get_cards_data
+import get_csv_data
+import get_sqlite_data
+import get_card_images
+import process_card_images
+
+# Constants
+RESULT_NAMES = ["cards", "types", "subtypes", "factions", "rarities"]
+
+def result_paths():
+    return {name: join(get_cards_data.OUTPUT_FOLDER, name + ".json") for name in RESULT_NAMES}
+
+# The stage functions return their number of failures, a stage which did not fully succeed
+# (None, or failures) runs again at the next run
+
+def run_csv(results):
+    get_csv_data.write_csv_files(results["cards"], results["types"], results["subtypes"], results["factions"], results["rarities"], get_csv_data.CSV_LANGUAGES, processes=get_csv_data.CSV_PROCESSES)
+    return 0
+
+def run_sqlite(results):
+    get_sqlite_data.write_sqlite(get_sqlite_data.SQLITE_OUTPUT_PATH, results["cards"], results["types"], results["subtypes"], results["factions"], results["rarities"])
+    return 0
+
+def run_images(results):
+    if not get_card_images.DOWNLOAD_CARD_IMAGES and not get_card_images.DOWNLOAD_ASSETS:
+        print("Nothing to do.")
+        return 0
+    return get_card_images.download_images(results["cards"])
+
+def run_variants(results):
+    return process_card_images.process_images()
+
+def csv_forks():
+    return get_csv_data.CSV_PROCESSES > 1 and len(get_csv_data.CSV_LANGUAGES) > 1
+
+# Stages run after the fetch: script whose parameters are part of the fingerprint, results used,
+# function run with the results, files written, whether it runs alongside the other stages, the
+# background stages it waits for, and whether it forks processes
+STAGES = {
+    "csv": {
+        "module": get_csv_data,
+        "inputs": RESULT_NAMES,
+        "run": run_csv,
+        "outputs": lambda: [get_csv_data.CSV_OUTPUT_PATH.format(language=language) for language in get_csv_data.CSV_LANGUAGES],
+        "background": False,
+        "forks": csv_forks
+    },
+    "sqlite": {
+        "module": get_sqlite_data,
+        "inputs": RESULT_NAMES,
+        "run": run_sqlite,
+        "outputs": lambda: [get_sqlite_data.SQLITE_OUTPUT_PATH],
+        "background": False
+    },
+    "images": {
+        "module": get_card_images,
+        "inputs": ["cards"],
+        "run": run_images,
+        "outputs": lambda: [get_card_images.MANIFEST_PATH],
+        # Downloading is network bound, it overlaps with the exports
+        "background": True
+    },
+    "variants": {
+        "module": process_card_images,
+        "inputs": ["cards"],
+        "run": run_variants,
+        "outputs": lambda: [process_card_images.VARIANTS_MANIFEST_PATH],
+        "background": False,
+        "after": ["images"]
+    }
+}
+
+def settings_fingerprint(module):
+    # The parameters of a script are its upper case globals
+    settings = {name: repr(value) for name, value in vars(module).items() if name.isupper()}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf8")).hexdigest()
+
+def inputs_fingerprint(module, result_hashes):
+    return hashlib.sha256(json.dumps({"settings": settings_fingerprint(module), "results": result_hashes}, sort_keys=True).encode("utf8")).hexdigest()
+
+def load_state(path=PIPELINE_STATE_PATH):
+    try:
+        return load_json(path)
+    except (OSError, ValueError):
+        return {}
+
+def is_stale(state, stage, inputs, outputs):
+    return state.get(stage, {}).get("inputs") != inputs or not all(exists(path) for path in outputs)
+
+def run_pipeline(stages=PIPELINE_STAGES, force=False, resume=False):
+    # Runs the stale stages, make-style: a stage runs again when its parameters or its input
+    # results changed, or when one of its outputs is missing. The results of the fetch stay in
+    # memory for the other stages, and are only read from the files when the fetch is skipped
+    state = load_state()
+    results = None
+
+    if "fetch" in stages:
+        inputs = settings_fingerprint(get_cards_data)
+        age = time.time() - state.get("fetch", {}).get("finished_at", 0)
+        if force or age >= FETCH_MAX_AGE or is_stale(state, "fetch", inputs, result_paths().values()):
+            print("==== Stage fetch ====")
+            with metrics.timer("stage_fetch"):
+                fetched = get_cards_data.fetch_cards_data(resume=resume)
+            if fetched is not None:
+                results = dict(zip(RESULT_NAMES, fetched))
+            state["fetch"] = {"inputs": inputs, "finished_at": time.time()}
+            dump_json(state, PIPELINE_STATE_PATH)
+        else:
+            print(f"Stage fetch is up to date (fetched {age / 3600:.1f} hours ago)")
+
+    if not check_files_exist(result_paths().values()):
+        return
+    result_hashes = {name: file_sha256(path) for name, path in result_paths().items()}
+    stale_stages = []
+    for stage in stages:
+        if stage == "fetch":
+            continue
+        inputs = inputs_fingerprint(STAGES[stage]["module"], {name: result_hashes[name] for name in STAGES[stage]["inputs"]})
+        # A stage also runs again after the stages it waits for
+        if force or is_stale(state, stage, inputs, STAGES[stage]["outputs"]()) or any(dependency == stale_stage for dependency in STAGES[stage].get("after", []) for stale_stage, _ in stale_stages):
+            stale_stages.append((stage, inputs))
+        else:
+            print(f"Stage {stage} is up to date")
+    if not stale_stages:
+        return
+
+    if results is None:
+        with metrics.timer("load"):
+            results = {name: load_results_json(path) for name, path in result_paths().items()}
+
+    def run_stage(stage, inputs):
+        print(f"==== Stage {stage} ====")
+        with metrics.timer("stage_" + stage):
+            failures = STAGES[stage]["run"](results)
+        return inputs, failures
+
+    def stage_done(stage, inputs, failures):
+        if failures == 0:
+            state[stage] = {"inputs": inputs, "finished_at": time.time()}
+        else:
+            print(f"Stage {stage} did not complete{f' ({failures} failures)' if failures else ''}, it will run again next time")
+            state.pop(stage, None)
+        dump_json(state, PIPELINE_STATE_PATH)
+
+    # The stages forking processes run before the background stages start: a child forked while
+    # another thread holds a lock (of the HTTP sessions, of the metrics...) would never get it
+    forking = [(stage, inputs) for stage, inputs in stale_stages if STAGES[stage].get("forks", lambda: False)() and not STAGES[stage].get("after")]
+    for stage, inputs in forking:
+        stage_done(stage, *run_stage(stage, inputs))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        background = {stage: executor.submit(run_stage, stage, inputs) for stage, inputs in stale_stages if STAGES[stage]["background"]}
+        for stage, inputs in stale_stages:
+            if stage not in background and (stage, inputs) not in forking:
+                for dependency in STAGES[stage].get("after", []):
+                    if dependency in background:
+                        stage_done(dependency, *background.pop(dependency).result())
+                stage_done(stage, *run_stage(stage, inputs))
+        for stage, future in background.items():
+            stage_done(stage, *future.result())
+
+def main():
+    run_pipeline(force="--force" in sys.argv[1:], resume="--resume" in sys.argv[1:])
+
+if __name__ == "__main__":
+    metrics.run_instrumented("pipeline", main)
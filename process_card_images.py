@@ -0,0 +1,167 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+THUMBNAIL_WIDTHS = [256, 512] # widths in pixels of the thumbnails, written in the format of the original and in VARIANT_FORMATS
+VARIANT_FORMATS = ["webp", "avif"] # formats of the variants of the full size images and of the thumbnails
+VARIANT_QUALITY = 80 # 0 to 100
+PROCESS_ASSETS = False # also make variants of the downloaded assets
+PROCESSES = None # number of processes, None uses all the CPUs
+VARIANTS_MANIFEST_PATH = "card_images_variants.json"
+
+# Imports
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import dump_json_atomic, load_json, check_files_exist
+import get_card_images # its parameters are read at call time, callers may change them
+import metrics
+try:
+    from PIL import Image
+except ImportError:
+    Image = None # Pillow is optional, it is only needed by this script
+
+# Constants
+VARIANTS_MANIFEST_VERSION = 1
+VARIANTS_MANIFEST_SAVE_EVERY = 500 # processed images
+PIL_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "webp": "WEBP", "avif": "AVIF"}
+
+def supported_formats(formats):
+    # Formats Pillow can write, some builds do not include AVIF
+    available = {extension.lstrip(".") for extension, pil_format in Image.registered_extensions().items() if pil_format in Image.SAVE}
+    for image_format in formats:
+        if image_format not in available:
+            print(f"Pillow cannot write {image_format} images, skipping them")
+    return [image_format for image_format in formats if image_format in available]
+
+def settings_key(formats):
+    return hashlib.sha256(json.dumps([THUMBNAIL_WIDTHS, formats, VARIANT_QUALITY]).encode("utf8")).hexdigest()[:16]
+
+def variant_paths(path, formats):
+    # Variants written next to the original: name.webp, name_256.jpg, name_256.webp...
+    stem, extension = os.path.splitext(path)
+    extension = extension.lstrip(".").lower()
+    variants = [(f"{stem}.{image_format}", None, image_format) for image_format in formats if image_format != extension]
+    for width in THUMBNAIL_WIDTHS:
+        for image_format in [extension] + [image_format for image_format in formats if image_format != extension]:
+            variants.append((f"{stem}_{width}.{image_format}", width, image_format))
+    return variants
+
+def make_variants(path, variants, quality):
+    # Runs in the worker processes. Returns the path and None, or the error message
+    tmp_path = None
+    try:
+        with Image.open(path) as image:
+            image.load()
+            resized = {None: image}
+            for variant_path, width, image_format in variants:
+                if width not in resized:
+                    # Thumbnails are never larger than the original
+                    resized[width] = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS) if width < image.width else image
+                variant = resized[width]
+                if PIL_FORMATS[image_format] == "JPEG" and variant.mode not in ("RGB", "L"):
+                    variant = variant.convert("RGB")
+                elif variant.mode not in ("RGB", "RGBA", "L"):
+                    variant = variant.convert("RGBA" if "A" in variant.mode or "transparency" in variant.info else "RGB")
+                tmp_path = variant_path + ".part"
+                variant.save(tmp_path, format=PIL_FORMATS[image_format], quality=quality)
+                os.replace(tmp_path, variant_path)
+        return path, None
+    except Exception as e:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return path, f"{type(e).__name__}: {e}"
+
+def load_variants_manifest(path=None):
+    path = path or VARIANTS_MANIFEST_PATH
+    if os.path.exists(path):
+        manifest = load_json(path)
+        if manifest.get("version") == VARIANTS_MANIFEST_VERSION:
+            return manifest
+        print(f"Ignoring {path}: unsupported manifest version")
+    return {"version": VARIANTS_MANIFEST_VERSION, "files": {}}
+
+def save_variants_manifest(manifest, path=None):
+    dump_json_atomic(manifest, path or VARIANTS_MANIFEST_PATH)
+
+def remove_variants(entry, keep=()):
+    for variant_path in entry["variants"]:
+        if variant_path not in keep and os.path.exists(variant_path):
+            os.remove(variant_path)
+
+def plan_variants(downloads_manifest, variants_manifest, formats):
+    # Images of the download manifest that are new or changed since their variants were made,
+    # or whose variants changed settings or are missing
+    folders = [get_card_images.CARD_IMAGES_FOLDER] + ([get_card_images.CARD_ASSETS_FOLDER] if PROCESS_ASSETS else [])
+    key = settings_key(formats)
+    jobs = []
+    unchanged = 0
+    sources = {}
+    for path, entry in downloads_manifest["files"].items():
+        if not any(path.startswith(folder + "/") for folder in folders) or os.path.splitext(path)[1].lstrip(".").lower() not in PIL_FORMATS or not os.path.exists(path):
+            continue
+        sources[path] = entry["sha256"]
+        variants = variant_paths(path, formats)
+        previous = variants_manifest["files"].get(path)
+        if previous is not None and previous["sha256"] == entry["sha256"] and previous["settings"] == key and all(os.path.exists(variant_path) for variant_path, _, _ in variants):
+            unchanged += 1
+            continue
+        if previous is not None:
+            # The variants still made are replaced in place, so that the mirror can be served meanwhile
+            remove_variants(previous, keep={variant_path for variant_path, _, _ in variants})
+        jobs.append((path, variants))
+    orphans = [path for path in variants_manifest["files"] if path not in sources]
+    return jobs, sources, unchanged, orphans
+
+def process_images(downloads_manifest=None, processes=PROCESSES):
+    # Makes the thumbnails and variants of the downloaded images, in a process pool. Returns
+    # the number of images that could not be processed, None if no image could be (no Pillow)
+    if Image is None:
+        print("Pillow is required to process the images: pip install Pillow")
+        return None
+    if downloads_manifest is None:
+        downloads_manifest = get_card_images.load_manifest()
+    formats = supported_formats(VARIANT_FORMATS)
+    variants_manifest = load_variants_manifest()
+    key = settings_key(formats)
+    with metrics.timer("plan"):
+        jobs, sources, unchanged, orphans = plan_variants(downloads_manifest, variants_manifest, formats)
+        if get_card_images.DELETE_ORPHANS:
+            for path in orphans:
+                remove_variants(variants_manifest["files"].pop(path))
+    metrics.increment("images_unchanged", unchanged)
+    print(f"{len(sources)} images: {len(jobs)} to process, {unchanged} unchanged, {len(orphans) if get_card_images.DELETE_ORPHANS else 0} orphans removed")
+    if not jobs:
+        save_variants_manifest(variants_manifest)
+        return 0
+
+    failed = 0
+    with metrics.timer("process"), ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(make_variants, path, variants, VARIANT_QUALITY): variants for path, variants in jobs}
+        try:
+            for nb_done, future in enumerate(as_completed(futures), 1):
+                path, error = future.result()
+                if error is None:
+                    variants_manifest["files"][path] = {"sha256": sources[path], "settings": key, "variants": [variant_path for variant_path, _, _ in futures[future]]}
+                    metrics.increment("images_processed")
+                else:
+                    print(f"Error processing {path}: {error}")
+                    variants_manifest["files"].pop(path, None)
+                    metrics.increment("images_failed")
+                    failed += 1
+                if nb_done % VARIANTS_MANIFEST_SAVE_EVERY == 0:
+                    save_variants_manifest(variants_manifest)
+        finally:
+            # Keep what was processed so far, even if the run is interrupted
+            save_variants_manifest(variants_manifest)
+    print(f"{len(jobs) - failed} images processed, {failed} failures")
+    return failed
+
+def main():
+    if not check_files_exist([get_card_images.MANIFEST_PATH], producer="get_card_images.py"):
+        return
+    process_images()
+
+if __name__ == "__main__":
+    metrics.run_instrumented("process_card_images", main)
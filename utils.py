@@ -19,36 +19,321 @@ LANGUAGE_HEADERS = {
     }
 }
 
+# Transport parameters
+REQUESTS_PER_SECOND = 10 # per host, for the API requests, None or 0 disables rate limiting
+DOWNLOAD_REQUESTS_PER_SECOND = None # per host, for the file downloads (fetch_file), None or 0 disables rate limiting
+REQUEST_TIMEOUT = 30 # seconds, for connecting and between two received bytes
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1 # seconds
+BACKOFF_MAX = 60 # seconds
+POOL_SIZE = 16 # keep-alive connections per host
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 256 * 1024 # bytes
+
+# Snapshots
+USE_SNAPSHOTS = True # load_results_json reads the binary snapshot of a result file instead, when it is up to date
+
 # Imports
 import requests
+import metrics
 import os
 import json
+import time
+import gc
+import pickle
+import struct
+import contextlib
+import random
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+class RateLimiter:
+    # Token bucket allowing bursts of up to one second worth of requests
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate) if rate else 1
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+_sessions = {}
+_rate_limiters = {}
+_transport_lock = threading.Lock()
+
+def get_session(host):
+    with _transport_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+def get_rate_limiter(host, download=False):
+    # The API requests and the file downloads of a host have separate limits
+    with _transport_lock:
+        if (host, download) not in _rate_limiters:
+            _rate_limiters[host, download] = RateLimiter(DOWNLOAD_REQUESTS_PER_SECOND if download else REQUESTS_PER_SECOND)
+        return _rate_limiters[host, download]
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+def retry_after_delay(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def http_get(url, headers=None, stream=False, timeout=None, max_attempts=None, download=False):
+    # GET through the pooled session of the host, retrying network errors and throttling responses.
+    # download selects the rate limit of the file downloads instead of the one of the API
+    timeout = timeout or REQUEST_TIMEOUT
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    host = urlsplit(url).netloc
+    session = get_session(host)
+    rate_limiter = get_rate_limiter(host, download)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        rate_limiter.acquire()
+        try:
+            response = session.get(url, headers=headers, stream=stream, timeout=timeout)
+        except requests.RequestException as e:
+            if attempt >= max_attempts:
+                metrics.record_request(url, type(e).__name__, time.perf_counter() - start, 0, attempt)
+                raise
+            delay = backoff_delay(attempt)
+            reason = type(e).__name__
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_attempts:
+                nb_bytes = int(response.headers.get("Content-Length", 0)) if stream else len(response.content)
+                metrics.record_request(url, response.status_code, time.perf_counter() - start, nb_bytes, attempt)
+                return response
+            delay = retry_after_delay(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            reason = f"HTTP {response.status_code}"
+            response.close()
+        metrics.increment("retries")
+        print(f"Error ({url}): {reason}. Retrying in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})...")
+        time.sleep(delay)
 
 def create_folder_if_not_exists(folder):
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-def download_file(url, filename, log=False, headers=None):
-    if log: print(f"Downloading {filename} from {url}")
-    response = requests.get(url, stream=True, headers=headers)
-    if not response.ok:
-        print(response)
-        return False
-    with open(filename, 'wb') as handle:
-        for block in response.iter_content(1024):
-            if not block:
-                break
-            handle.write(block)
+def check_files_exist(paths, producer="get_cards_data.py"):
+    # Returns False, after telling which script creates it, if one of the input files is missing
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"File {path} not found. Have you run {producer}?")
+            return False
     return True
 
-def dump_json(data, filename):
+def download_file(url, filename, log=False, headers=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    return fetch_file(url, filename, log=log, headers=headers, chunk_size=chunk_size)[0] == "downloaded"
+
+def fetch_file(url, filename, log=False, headers=None, chunk_size=DOWNLOAD_CHUNK_SIZE, etag=None, last_modified=None):
+    # Returns ("downloaded", info), ("not_modified", None) or ("failed", None), where info
+    # holds the etag, last_modified, size and sha256 of the downloaded file.
+    # The file is written to a temporary path and renamed once complete, so an
+    # interrupted download never leaves a truncated file behind
+    if log: print(f"Downloading {filename} from {url}")
+    headers = dict(headers) if headers else {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    tmp_filename = filename + ".part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        response = http_get(url, headers=headers, stream=True, download=True)
+        with response:
+            if response.status_code == 304:
+                return "not_modified", None
+            if not response.ok:
+                print(response)
+                return "failed", None
+            with open(tmp_filename, 'wb') as handle:
+                for block in response.iter_content(chunk_size):
+                    if not block:
+                        break
+                    handle.write(block)
+                    sha256.update(block)
+                    size += len(block)
+        os.replace(tmp_filename, filename)
+    except (requests.RequestException, OSError) as e:
+        # Network errors, and write errors (disk full, permissions...): the download is counted
+        # as failed, without stopping the other downloads
+        print(e)
+        try:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        except OSError:
+            pass
+        return "failed", None
+    return "downloaded", {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "size": size,
+        "sha256": sha256.hexdigest()
+    }
+
+def file_sha256(filename, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# Snapshot format: magic, header length, JSON header (version, size and modification time of
+# the JSON file, SHA-256 of the payload), then the data pickled with protocol 5
+SNAPSHOT_MAGIC = b"ALTSNAP\n"
+SNAPSHOT_VERSION = 1
+
+def dump_json(data, filename, snapshot=False):
     with open(filename, 'w', encoding="utf8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+    if snapshot:
+        write_snapshot(data, filename)
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='w'):
+    # File object writing to filename.part, renamed to filename once complete: readers never see
+    # a partially written file, and an interrupted write leaves the previous file as it was
+    tmp_filename = filename + ".part"
+    try:
+        with open(tmp_filename, mode, encoding=None if "b" in mode else "utf8") as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, filename)
+
+def dump_json_atomic(data, filename):
+    # Same as dump_json, through atomic_write
+    with atomic_write(filename) as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+def snapshot_path(filename):
+    return filename + ".snapshot"
+
+def write_snapshot(data, filename):
+    # Binary copy of the data of the JSON file filename, much faster to load. It is only valid
+    # as long as the JSON file is not modified, and the data must only contain JSON types
+    payload = pickle.dumps(data, protocol=5)
+    stat = os.stat(filename)
+    header = json.dumps({
+        "version": SNAPSHOT_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": hashlib.sha256(payload).hexdigest()
+    }).encode("utf8")
+    with atomic_write(snapshot_path(filename), 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header)) + header)
+        f.write(payload)
+
+def load_snapshot(filename):
+    # Returns the data of the snapshot of the JSON file filename, or None if there is no
+    # snapshot, or if it is outdated or corrupted
+    try:
+        stat = os.stat(filename)
+        with open(snapshot_path(filename), 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    prefix_length = len(SNAPSHOT_MAGIC) + 4
+    if len(content) < prefix_length or content[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return None
+    header_length = struct.unpack("<I", content[len(SNAPSHOT_MAGIC):prefix_length])[0]
+    try:
+        header = json.loads(content[prefix_length:prefix_length + header_length])
+    except ValueError:
+        return None
+    if header.get("version") != SNAPSHOT_VERSION or header.get("size") != stat.st_size or header.get("mtime") != stat.st_mtime_ns:
+        return None
+    payload = memoryview(content)[prefix_length + header_length:]
+    if hashlib.sha256(payload).hexdigest() != header.get("sha256"):
+        print(f"Snapshot of {filename} is corrupted, loading the JSON file")
+        return None
+    with paused_gc():
+        return pickle.loads(payload)
+
+class JsonObjectWriter:
+    # Writes a JSON object one item at a time, in the same format as dump_json
+    def __init__(self, filename):
+        self.file = open(filename, 'w', encoding="utf8")
+        self.count = 0
+
+    def write(self, key, value):
+        self.file.write(",\n  " if self.count else "{\n  ")
+        self.file.write(json.dumps(key, ensure_ascii=False) + ": " + json.dumps(value, indent=2, ensure_ascii=False).replace("\n", "\n  "))
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n}" if self.count else "{}")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+@contextlib.contextmanager
+def paused_gc():
+    # Loading allocates millions of containers that trigger the cyclic garbage collector again
+    # and again, while the loaded data has no cycles. Pausing it makes loading several times faster
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 def load_json(filename):
-    with open(filename, encoding="utf8") as f:
+    with open(filename, encoding="utf8") as f, paused_gc():
         return json.load(f)
 
+def load_results_json(filename):
+    # Loads a result file written by get_cards_data.py (cards, types...), from its snapshot if
+    # it has an up-to-date one. Snapshots are pickles: they are only read for these files
+    if USE_SNAPSHOTS:
+        data = load_snapshot(filename)
+        if data is not None:
+            return data
+    return load_json(filename)
+
 def load_txt(filename):
     with open(filename, encoding="utf8") as f:
         return f.read()
@@ -0,0 +1,184 @@
+# Script by Maverick CHARDET
+# MIT License
+
+# Parameters
+WATCH_INTERVAL = 600 # seconds between two checks of the catalog
+WATCH_STATE_FOLDER = "temp/watch" # fingerprints and raw cards of each (language, faction)
+CHANGE_LOG_PATH = "results/changes.ndjson" # one line per check where cards changed
+FULL_CHECK_EVERY = 6 # every N checks (hourly with WATCH_INTERVAL = 600), all the partitions are fetched again to catch the changes the fingerprints miss (errata...), 0 disables it
+
+# Imports
+import os
+import sys
+import json
+import time
+import hashlib
+from datetime import datetime
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from utils import dump_json_atomic, load_json, load_results_json, create_folder_if_not_exists
+import metrics
+from get_cards_data import (
+    LANGUAGES, OUTPUT_FOLDER, SKIP_NOT_ALL_LANGUAGES, INCLUDE_UNIQUES, INCLUDE_KS, INCLUDE_PROMO_CARDS,
+    INCLUDE_FOILERS, FORCE_INCLUDE_KS_UNIQUES, PAGE_SIZE, COLLECTION_TOKEN, MAX_WORKERS, FACTIONS,
+    MergeReport, get_page, get_data_language_faction, index_stats_data, treat_cards_data, merge_cards_data, merge_language_dicts
+)
+
+def get_fingerprint(apiEndpoint, language, faction, include_uniques, collection_token):
+    # hydra:totalItems and a hash of the first card, from a page of a single card
+    cards, total = get_page(apiEndpoint, language, 1, faction=faction, include_uniques=include_uniques, items_per_page=1, collection_token=collection_token)
+    return {"totalItems": total, "hash": content_hash(cards)}
+
+def content_hash(cards):
+    return hashlib.sha256(json.dumps(cards, sort_keys=True, ensure_ascii=False).encode("utf8")).hexdigest()
+
+def partition_key(apiEndpoint, language, faction):
+    return f"{apiEndpoint}/{language}/{faction}"
+
+def partition_path(state_folder, apiEndpoint, language, faction):
+    return join(state_folder, f"{apiEndpoint.replace('/', '_')}_{language}_{faction}.json")
+
+def load_state(state_folder):
+    try:
+        return load_json(join(state_folder, "state.json"))
+    except (OSError, ValueError):
+        return {"checks": 0, "partitions": {}}
+
+def diff_cards(old_cards, new_cards):
+    added = sorted(card_id for card_id in new_cards if card_id not in old_cards)
+    removed = sorted(card_id for card_id in old_cards if card_id not in new_cards)
+    modified = sorted(card_id for card_id in new_cards if card_id in old_cards and new_cards[card_id] != old_cards[card_id])
+    return added, removed, modified
+
+def watch_check(
+    state,
+    state_folder=WATCH_STATE_FOLDER,
+    output_folder=OUTPUT_FOLDER,
+    languages=LANGUAGES,
+    skip_not_all_languages=SKIP_NOT_ALL_LANGUAGES,
+    include_uniques=INCLUDE_UNIQUES,
+    include_ks=INCLUDE_KS,
+    include_promo_cards=INCLUDE_PROMO_CARDS,
+    include_foilers=INCLUDE_FOILERS,
+    force_include_ks_uniques=FORCE_INCLUDE_KS_UNIQUES,
+    items_per_page=PAGE_SIZE,
+    collection_token=COLLECTION_TOKEN,
+    max_workers=MAX_WORKERS,
+    full_check_every=FULL_CHECK_EVERY
+):
+    # Checks the fingerprints of every (endpoint, language, faction), fetches the partitions whose
+    # fingerprint changed, and patches the results for the factions whose cards changed.
+    # Returns the change log entry, or None if nothing changed
+    create_folder_if_not_exists(state_folder)
+    cards_path = join(output_folder, 'cards.json')
+    state["checks"] += 1
+    full_check = full_check_every and state["checks"] % full_check_every == 0
+
+    partitions = [("cards", language, faction) for language in languages for faction in FACTIONS]
+    if collection_token:
+        # Collection stats are not language specific
+        partitions += [("cards/stats", "en", faction) for faction in FACTIONS]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fingerprints = list(executor.map(lambda partition: get_fingerprint(*partition, include_uniques, collection_token), partitions))
+
+    # Without results, they are rebuilt from all the partitions
+    changed_factions = set(FACTIONS) if not os.path.exists(cards_path) else set()
+    for (apiEndpoint, language, faction), fingerprint in zip(partitions, fingerprints):
+        key = partition_key(apiEndpoint, language, faction)
+        path = partition_path(state_folder, apiEndpoint, language, faction)
+        previous = state["partitions"].get(key)
+        if not full_check and previous is not None and previous["fingerprint"] == fingerprint and os.path.exists(path):
+            continue
+        print(f"Fetching {apiEndpoint} {language} {faction}")
+        raw_cards = get_data_language_faction(apiEndpoint, language, faction, include_uniques=include_uniques, items_per_page=items_per_page, collection_token=collection_token)
+        raw_cards_hash = content_hash(raw_cards)
+        if previous is None or previous["content"] != raw_cards_hash or not os.path.exists(path):
+            dump_json_atomic(raw_cards, path)
+            changed_factions.add(faction)
+        state["partitions"][key] = {"fingerprint": fingerprint, "content": raw_cards_hash}
+
+    if not changed_factions:
+        dump_json_atomic(state, join(state_folder, "state.json"))
+        return None
+
+    # The stats and the references are joined over the whole catalog, from the saved partitions
+    stats_index = {}
+    if collection_token:
+        stats_index = index_stats_data([stats for faction in FACTIONS for stats in load_json(partition_path(state_folder, "cards/stats", "en", faction))])
+    treated_cards = {}
+    treated_references = [{}, {}, {}, {}]
+    for language in languages:
+        treated_cards[language] = {}
+        language_references = [{}, {}, {}, {}]
+        for faction in FACTIONS:
+            raw_cards = load_json(partition_path(state_folder, "cards", language, faction))
+            tcards, *references = treat_cards_data(
+                raw_cards,
+                stats_index,
+                include_uniques=include_uniques,
+                include_ks=include_ks,
+                include_promo_cards=include_promo_cards,
+                include_foilers=include_foilers,
+                force_include_ks_uniques=force_include_ks_uniques
+            )
+            treated_cards[language][faction] = tcards
+            for merged, faction_references in zip(language_references, references):
+                merged.update(faction_references)
+        for treated, merged in zip(treated_references, language_references):
+            treated[language] = merged
+
+    cards = load_results_json(cards_path) if os.path.exists(cards_path) else {}
+    merge_report = MergeReport()
+    added, removed, modified = [], [], []
+    for faction in sorted(changed_factions):
+        old_cards = {card_id: card for card_id, card in cards.items() if card["mainFaction"] == faction}
+        new_cards = merge_cards_data({language: treated_cards[language][faction] for language in languages}, skip_not_all_languages=skip_not_all_languages, is_collection=bool(collection_token), report=merge_report)
+        faction_added, faction_removed, faction_modified = diff_cards(old_cards, new_cards)
+        added += faction_added
+        removed += faction_removed
+        modified += faction_modified
+        for card_id in faction_removed:
+            del cards[card_id]
+        cards.update(new_cards)
+
+    print(merge_report.summary())
+    create_folder_if_not_exists(output_folder)
+    dump_json_atomic(cards, cards_path)
+    for name, treated in zip(["types", "subtypes", "factions", "rarities"], treated_references):
+        dump_json_atomic(merge_language_dicts(treated), join(output_folder, name + '.json'))
+    dump_json_atomic(state, join(state_folder, "state.json"))
+
+    if not added and not removed and not modified:
+        return None
+    return {
+        "date": datetime.now().isoformat(),
+        "factions": sorted(changed_factions),
+        "added": added,
+        "removed": removed,
+        "modified": modified
+    }
+
+def check_catalog(state):
+    print(f"Checking the catalog ({datetime.now().isoformat(timespec='seconds')})")
+    changes = watch_check(state)
+    if changes is None:
+        print("No changes")
+    else:
+        print(f"{len(changes['added'])} added, {len(changes['removed'])} removed, {len(changes['modified'])} modified card(s)")
+        create_folder_if_not_exists(os.path.dirname(CHANGE_LOG_PATH) or ".")
+        with open(CHANGE_LOG_PATH, 'a', encoding="utf8") as f:
+            f.write(json.dumps(changes, ensure_ascii=False) + "\n")
+
+def main():
+    # Checks the catalog every WATCH_INTERVAL seconds, or once with the --once argument. Each
+    # check writes its own metrics, so that they do not pile up in memory while watching
+    once = "--once" in sys.argv[1:]
+    state = load_state(WATCH_STATE_FOLDER)
+    while True:
+        metrics.run_instrumented("watch_cards_data", lambda: check_catalog(state))
+        if once:
+            break
+        time.sleep(WATCH_INTERVAL)
+
+if __name__ == "__main__":
+    main()